@@ -0,0 +1,310 @@
+"""
+Benchmark suite for the birds data and inference paths.
+
+Generates synthetic VIA datasets and videos in a temporary directory, so
+neither the real dataset nor a GPU is needed. Detection is replaced by a
+stub model that returns random masks. Times load_birds(), load_mask(),
+color_splash() and the video loop of detect_and_color_splash() over a
+grid of sizes, and writes the results as JSON.
+
+Also times `import birds` in a fresh interpreter and lists the heavy
+modules it loaded. The import budget itself is checked by
+tests/test_import.py.
+
+Usage:
+
+    # Full grid
+    python3 benchmarks/bench_birds.py --output=bench.json
+
+    # Quick run, e.g. before and after a change
+    python3 benchmarks/bench_birds.py --quick --output=bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import argparse
+import tempfile
+import datetime
+import numpy as np
+import skimage.io
+
+# Import birds.py from the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import birds
+
+
+############################################################
+#  Synthetic data
+############################################################
+
+def synthetic_polygon(rng, height, width, vertices=16):
+    """Return x and y vertex lists of a random star-shaped polygon."""
+    cy, cx = rng.uniform(0.2, 0.8) * height, rng.uniform(0.2, 0.8) * width
+    radius = rng.uniform(0.05, 0.2) * min(height, width)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, vertices))
+    radii = radius * rng.uniform(0.5, 1.0, vertices)
+    xs = np.clip(cx + radii * np.cos(angles), 0, width - 1).astype(int)
+    ys = np.clip(cy + radii * np.sin(angles), 0, height - 1).astype(int)
+    return xs.tolist(), ys.tolist()
+
+
+def make_dataset(dataset_dir, images, height, width, instances, seed=0):
+    """Write a synthetic VIA dataset with a "train" subset.
+    Every image is a small random JPEG of the given size with the given
+    number of polygon instances.
+    """
+    rng = np.random.RandomState(seed)
+    subset_dir = os.path.join(dataset_dir, "train")
+    os.makedirs(subset_dir, exist_ok=True)
+    # Images are only probed for their size, so they can share the pixels
+    pixels = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    annotations = {}
+    for i in range(images):
+        filename = "bird_{:06d}.jpg".format(i)
+        skimage.io.imsave(os.path.join(subset_dir, filename), pixels,
+                          check_contrast=False)
+        regions = {}
+        for j in range(instances):
+            xs, ys = synthetic_polygon(rng, height, width)
+            regions[str(j)] = {
+                "shape_attributes": {"name": "polygon",
+                                     "all_points_x": xs, "all_points_y": ys},
+                "region_attributes": {"birds": str(rng.randint(1, 101))}}
+        annotations[filename] = {"filename": filename, "size": 0,
+                                 "regions": regions}
+    with open(os.path.join(subset_dir, "via_region_data.json"), "w") as f:
+        json.dump(annotations, f)
+
+
+def make_video(path, frames, height, width, seed=0):
+    """Write a synthetic MJPG video of a static scene with a moving blob."""
+    import cv2
+    rng = np.random.RandomState(seed)
+    background = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    vwriter = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 25,
+                              (width, height))
+    for i in range(frames):
+        frame = background.copy()
+        x = (i * 7) % max(width - height // 4, 1)
+        frame[height // 3:height // 3 + height // 4, x:x + height // 4] = 255
+        vwriter.write(frame)
+    vwriter.release()
+
+
+class StubConfig(object):
+    def __init__(self, batch_size):
+        self.BATCH_SIZE = batch_size
+
+
+class StubModel(object):
+    """Stands in for MaskRCNN in inference mode. detect() returns random
+    rectangular masks, and takes no time of its own, so the benchmark
+    measures everything around the model.
+    """
+
+    def __init__(self, instances, batch_size=1, seed=0):
+        self.config = StubConfig(batch_size)
+        self.instances = instances
+        self.rng = np.random.RandomState(seed)
+
+    def detect(self, images, verbose=0):
+        assert len(images) == self.config.BATCH_SIZE
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            masks = np.zeros((height, width, self.instances), dtype=bool)
+            rois = np.zeros((self.instances, 4), dtype=np.int32)
+            for i in range(self.instances):
+                y1, x1 = self.rng.randint(0, height // 2), self.rng.randint(0, width // 2)
+                y2, x2 = y1 + height // 4, x1 + width // 4
+                masks[y1:y2, x1:x2, i] = True
+                rois[i] = [y1, x1, y2, x2]
+            results.append({"rois": rois, "masks": masks,
+                            "class_ids": np.ones([self.instances], np.int32),
+                            "scores": np.ones([self.instances], np.float32)})
+        return results
+
+
+############################################################
+#  Benchmarks
+############################################################
+
+def timed(func, repeat):
+    """Run func repeat times. Returns the timing stats in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": float(np.median(times)),
+            "mean": float(np.mean(times)), "repeat": repeat}
+
+
+# Modules that dominate the startup of `import birds`, reported when it
+# loads them. Same list as tests/test_import.py.
+HEAVY_MODULES = ["tensorflow", "keras", "mrcnn.model", "mrcnn.utils",
+                 "imgaug", "skimage", "cv2"]
+
+
+def bench_import(repeat):
+    """Time `import birds` in fresh interpreters and list the heavy
+    modules it loaded.
+    """
+    repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    code = ("import sys, json, time; t = time.perf_counter(); import birds; "
+            "t = time.perf_counter() - t; "
+            "print(json.dumps([t, [m for m in {} if m in sys.modules]]))".format(
+                json.dumps(HEAVY_MODULES)))
+    times = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=repo_dir)
+        seconds, loaded = json.loads(output.decode())
+        times.append(seconds)
+    return {"min": min(times), "median": float(np.median(times)),
+            "mean": float(np.mean(times)), "repeat": repeat,
+            "heavy_modules": loaded}
+
+
+def bench_load_birds(work_dir, images, height, width, instances, repeat):
+    dataset_dir = os.path.join(work_dir, "dataset_{}_{}x{}_{}".format(
+        images, height, width, instances))
+    make_dataset(dataset_dir, images, height, width, instances)
+    index_path = os.path.join(dataset_dir, "train", birds.BIRDS_INDEX_FILE)
+
+    def load(use_index):
+        dataset = birds.BirdsDataset()
+        dataset.load_birds(dataset_dir, "train", use_index=use_index)
+        return dataset
+
+    def cold():
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        load(True)
+
+    results = {"cold": timed(cold, repeat),
+               "cached": timed(lambda: load(True), repeat),
+               "no_index": timed(lambda: load(False), repeat)}
+    return results, load(True)
+
+
+def bench_load_mask(dataset, repeat):
+    dataset.prepare()
+    image_ids = dataset.image_ids[:50]
+
+    def dense():
+        for i in image_ids:
+            dataset.load_mask(i)
+
+    def cropped():
+        for i in image_ids:
+            dataset.load_mask_cropped(i)
+
+    count = max(len(image_ids), 1)
+    results = {"dense": timed(dense, repeat), "cropped": timed(cropped, repeat)}
+    for r in results.values():
+        r["per_image"] = r["median"] / count
+    return results
+
+
+def bench_color_splash(height, width, instances, repeat):
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    masks = StubModel(instances).detect([image])[0]["masks"]
+    out = np.empty_like(image)
+    return {"alloc": timed(lambda: birds.color_splash(image, masks), repeat),
+            "out_buffer": timed(lambda: birds.color_splash(image, masks, out=out), repeat)}
+
+
+def bench_video(work_dir, frames, height, width, instances, batch_size, repeat):
+    import cv2
+    video_path = os.path.join(work_dir, "video_{}x{}.avi".format(height, width))
+    make_video(video_path, frames, height, width)
+    output_path = os.path.join(work_dir, "splash.avi")
+
+    def run():
+        vcapture = cv2.VideoCapture(video_path)
+        vwriter = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'MJPG'),
+                                  25, (width, height))
+        try:
+            birds.splash_video(StubModel(instances, batch_size), vcapture, vwriter)
+        finally:
+            vwriter.release()
+            vcapture.release()
+
+    result = timed(run, repeat)
+    result["fps"] = frames / result["median"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the birds data and inference paths.')
+    parser.add_argument('--output', required=False, default="bench_birds.json",
+                        metavar="/path/to/results.json",
+                        help='JSON file to write the results to')
+    parser.add_argument('--quick', action="store_true",
+                        help='Run a small grid with fewer repeats')
+    parser.add_argument('--repeat', required=False, default=None, type=int,
+                        help='Repeats per measurement')
+    args = parser.parse_args()
+
+    if args.quick:
+        dataset_sizes, image_sizes, instance_counts = [200], [(480, 640)], [1, 4]
+        video_frames, repeat = 30, args.repeat or 2
+    else:
+        dataset_sizes = [200, 2000]
+        image_sizes = [(480, 640), (1080, 1920)]
+        instance_counts = [1, 4, 16]
+        video_frames, repeat = 100, args.repeat or 3
+
+    results = {"created": datetime.datetime.now().isoformat(),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "machine": platform.machine(),
+               "cpus": os.cpu_count(),
+               "benchmarks": []}
+
+    def record(name, params, timings):
+        print(name, params, json.dumps(timings))
+        results["benchmarks"].append({"name": name, "params": params,
+                                      "results": timings})
+
+    record("import", {}, bench_import(max(repeat, 3)))
+
+    work_dir = tempfile.mkdtemp(prefix="bench_birds_")
+    try:
+        for images in dataset_sizes:
+            for height, width in image_sizes:
+                for instances in instance_counts:
+                    params = {"images": images, "height": height,
+                              "width": width, "instances": instances}
+                    timings, dataset = bench_load_birds(
+                        work_dir, images, height, width, instances, repeat)
+                    record("load_birds", params, timings)
+                    if images == dataset_sizes[0]:
+                        record("load_mask", params, bench_load_mask(dataset, repeat))
+        for height, width in image_sizes:
+            for instances in instance_counts:
+                params = {"height": height, "width": width, "instances": instances}
+                record("color_splash", params,
+                       bench_color_splash(height, width, instances, repeat * 5))
+                for batch_size in [1, 4]:
+                    params = dict(params, frames=video_frames, batch_size=batch_size)
+                    record("video", params,
+                           bench_video(work_dir, video_frames, height, width,
+                                       instances, batch_size, repeat))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Saved to ", args.output)
+
+
+if __name__ == '__main__':
+    main()
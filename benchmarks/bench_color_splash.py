@@ -0,0 +1,67 @@
+"""
+Microbenchmark of birds.color_splash() against the original float64
+implementation, on synthetic frames.
+
+Usage:
+
+    python3 benchmarks/bench_color_splash.py --height=1080 --width=1920 --instances=3
+"""
+
+import os
+import sys
+import timeit
+import argparse
+import numpy as np
+import skimage.color
+
+# Import birds.py from the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import birds
+
+
+def color_splash_reference(image, mask):
+    """The original color_splash(), kept as the baseline."""
+    gray = skimage.color.gray2rgb(skimage.color.rgb2gray(image)) * 255
+    if mask.shape[-1] > 0:
+        mask = (np.sum(mask, -1, keepdims=True) >= 1)
+        splash = np.where(mask, image, gray).astype(np.uint8)
+    else:
+        splash = gray.astype(np.uint8)
+    return splash
+
+
+def synthetic_frame(height, width, instances, seed=0):
+    """Return a random RGB frame and a mask of random rectangles."""
+    rng = np.random.RandomState(seed)
+    image = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    mask = np.zeros((height, width, instances), dtype=bool)
+    for i in range(instances):
+        y1, x1 = rng.randint(0, height // 2), rng.randint(0, width // 2)
+        mask[y1:y1 + height // 4, x1:x1 + width // 4, i] = True
+    return image, mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark color_splash().')
+    parser.add_argument('--height', default=1080, type=int)
+    parser.add_argument('--width', default=1920, type=int)
+    parser.add_argument('--instances', default=3, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    args = parser.parse_args()
+
+    image, mask = synthetic_frame(args.height, args.width, args.instances)
+    out = np.empty_like(image)
+    assert np.array_equal(color_splash_reference(image, mask),
+                          birds.color_splash(image, mask, out=out))
+
+    def best(stmt):
+        return min(timeit.repeat(stmt, number=1, repeat=args.repeat))
+
+    reference = best(lambda: color_splash_reference(image, mask))
+    fast = best(lambda: birds.color_splash(image, mask, out=out))
+    print("reference: {:8.2f} ms".format(reference * 1000))
+    print("fast:      {:8.2f} ms  ({:.1f}x)".format(fast * 1000, reference / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,28 +20,66 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
     # Train a new model starting from ImageNet weights
     python3 birds.py train --dataset=../../dataset/birds --weights=imagenet
 
+    # Pack the train and val subsets into shards, and train from them
+    python3 birds.py pack --dataset=../../dataset/birds --output=shards/
+    python3 birds.py train --shards=shards/ --weights=coco
+
+    # Evaluate box and mask AP on the validation set
+    python3 birds.py evaluate --dataset=../../dataset/birds --weights=last --workers=4
+
+    # Serve detections over HTTP, batching up to 4 concurrent requests
+    python3 birds.py serve --weights=last --batch-size=4 --port=8000
+    curl --data-binary @bird.jpg http://127.0.0.1:8000/detect
+
     # Apply color splash to an image
     python3 balloon.py splash --weights=/path/to/weights/file.h5 --image=<URL or path to file>
 
+    # Detect small birds in a high resolution image in 1024 pixel tiles
+    python3 birds.py splash --weights=last --image=<URL or path to file> --tile=1024
+
     # Apply color splash to video using the last weights you trained
     python3 balloon.py splash --weights=last --video=<URL or path to file>
+
+    # Write the detections of a video as JSON lines, one per frame, without a splash
+    python3 birds.py splash --weights=last --video=<URL or path to file> --detections=birds.jsonl --no-splash
+
+    # Apply color splash to a directory, glob or list of images, resumably
+    python3 birds.py splash --weights=last --images=<dir, glob or list.txt> --output=splash/ --workers=4
 """
 
 import os
+import io
 import sys
+import glob
+import stat
 import json
+import pickle
+import functools
+import concurrent.futures
+import struct
+import hashlib
+import time
 import datetime
+import collections
+import queue
+import threading
+import multiprocessing
+import contextlib
+import bisect
+import atexit
+import socketserver
+import http.server
 import numpy as np
-import skimage.draw
-import imgaug
-from imgaug import augmenters as iaa
 # Root directory of the project
 ROOT_DIR = os.path.abspath("../..")
 
 # Import Mask RCNN
+# Only the config is imported here. mrcnn.model and mrcnn.utils pull in
+# TensorFlow, and skimage and imgaug are slow to import too, so they're
+# imported by the code that needs them. That keeps `import birds` and
+# `birds.py --help` fast.
 sys.path.append(ROOT_DIR)  # To find local version of the library
 from mrcnn.config import Config
-from mrcnn import model as modellib, utils
 
 # Path to trained weights file
 Birds_MODEL_PATH = os.path.join("mask_rcnn_birds_0197.h5")
@@ -50,6 +88,41 @@ Birds_MODEL_PATH = os.path.join("mask_rcnn_birds_0197.h5")
 # through the command line argument --logs
 DEFAULT_LOGS_DIR = os.path.join(ROOT_DIR, "logs")
 
+# Species of the dataset, in class ID order starting at 1 (0 is background)
+BIRD_CLASSES = (
+    "Acadian_Flycatcher", "American_Crow", "American_Goldfinch",
+    "Anna_Hummingbird", "Baltimore_Oriole", "Belted_Kingfisher",
+    "Black_Billed_Cuckoo", "Black_Footed_Albatross", "Blue_Grosbeak",
+    "Blue_Jay", "Boat_Tailed_Grackle", "Bobolink", "Brandt_Cormorant",
+    "Brewer_Blackbird", "Bronzed_Cowbird", "Brown_Creeper", "Brown_Pelican",
+    "California_Gull", "Cardinal", "Chuck_Will_Widow", "Clark_Nutcracker",
+    "Crested_Auklet", "Dark_Eyed_Junco", "Eared_Grebe", "Eastern_Towhee",
+    "European_Goldfinch", "Evening_Grosbeak", "Fish_Crow", "Florida_Jay",
+    "Frigatebird", "Gadwall", "Glaucous_Winged_Gul", "Gray_Catbird",
+    "Gray_Crowned_Rosy_Finch", "Gray_Kingbird", "Great_Crested_Flycatcher",
+    "Green_Jay", "Green_Kingfisher", "Green_Violetear", "Groove_Billed_Ani",
+    "Heermann_Gull", "Herring_Gull", "Hooded_Merganser", "Hooded_Oriole",
+    "Horned_Grebe", "Horned_Lark", "Indigo_Bunting", "Ivory_Gull",
+    "Laysan_Albatross", "Lazuli_Bunting", "Least_Auklet", "Least_Flycatcher",
+    "Long_Tailed_Jaeger", "Mallard", "Mangrove_Cuckoo", "Mockingbird",
+    "Nighthawk", "Northern_Flicker", "Northern_Fulmar",
+    "Olive_Sided_Flycatcher", "Orchard_Oriole", "Ovenbird", "Pacific_Loon",
+    "Painted_Bunting", "Parakeet_Auklet", "Pelagic_Cormorant",
+    "Pied_Billed_Grebe", "Pied_Kingfisher", "Pigeon_Guillemot",
+    "Pine_Grosbeak", "Pomarine_Jaeger", "Purple_Finch",
+    "Red_Breasted_Merganser", "Red_Faced_Cormorant", "Red_Legged_Kittiwake",
+    "Red_Winged_Blackbird", "Rhinoceros_Auklet", "Ring_Billed_Gull",
+    "Ringed_Kingfisher", "Rose_Breasted_Grosbeak", "Ruby_Throated_Hummingbird",
+    "Rufous_Humming", "Rusty_Blackbird", "Scissor_Tailed_Flycatcher",
+    "Scott_Oriole", "Shiny_Cowbird", "Slaty_Backed_Gull", "Sooty_Albatross",
+    "Spotted_Catbird", "Tropical_Kingbird", "Vermilion_Flycatcher",
+    "Western_Grebe", "Western_Gull", "Western_Meadowlark",
+    "White_Breasted_Kingfisher", "White_Breasted_Nuthatch",
+    "Yellow_Bellied_Flycatcher", "Yellow_Billed_Cuckoo",
+    "Yellow_Breasted_Chat", "Yellow_Headed_Blackbird",
+)
+
+
 ############################################################
 #  Configurations
 ############################################################
@@ -75,118 +148,974 @@ class BirdsConfig(Config):
     DETECTION_MIN_CONFIDENCE = 0.5
 
 
+class InferenceConfig(BirdsConfig):
+    """Configuration for running detection with a trained model."""
+    # Batch size = GPU_COUNT * IMAGES_PER_GPU. Defaults to 1 image at
+    # a time, video frames can be detected in larger batches.
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+    DETECTION_MIN_CONFIDENCE = 0
+
+    def __init__(self, images_per_gpu=None):
+        if images_per_gpu:
+            self.IMAGES_PER_GPU = images_per_gpu
+        super().__init__()
+
+
+############################################################
+#  Metrics
+############################################################
+
+class NullMetrics(object):
+    """Metrics sink that records nothing. Used while metrics are disabled,
+    so instrumented code costs one no-op call per hook.
+    """
+    enabled = False
+    _null_stage = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._null_stage
+
+    def observe(self, name, seconds):
+        pass
+
+    def add_frames(self, count=1):
+        pass
+
+    def flush(self):
+        pass
+
+
+class Metrics(NullMetrics):
+    """Records per-stage latency histograms, frame rate and peak RSS, and
+    periodically writes them to a file.
+
+    path: Output file. Files ending in .prom are written in the Prometheus
+        textfile format (replaced on every flush), anything else gets one
+        JSON line appended per flush.
+    interval: Seconds between flushes.
+
+    Forked data loader processes inherit the object and report on their
+    own, with their pid in every JSON line, or in a .prom file suffixed
+    with their pid.
+    """
+    enabled = True
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0, float("inf"))
+
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        # Serializes flushes, so their lines and files never interleave
+        self._flush_lock = threading.Lock()
+        self._stages = {}
+        self._frames = 0
+        self._start = self._last_flush = time.monotonic()
+        self._next_flush = self._start + interval
+        self._last_frames = 0
+
+    def stage(self, name):
+        """Context manager that times its block as stage name."""
+        return _StageTimer(self, name)
+
+    def observe(self, name, seconds):
+        """Record one measurement of a stage."""
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = {
+                    "buckets": np.zeros([len(self.BUCKETS)], dtype=np.int64),
+                    "count": 0, "sum": 0.0, "max": 0.0}
+            stage["buckets"][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            stage["count"] += 1
+            stage["sum"] += seconds
+            stage["max"] = max(stage["max"], seconds)
+            # Claim the flush under the lock, so only one of the threads
+            # that see it's due does it
+            now = time.monotonic()
+            due = now >= self._next_flush
+            if due:
+                self._next_flush = now + self.interval
+        if due:
+            self.flush()
+
+    def add_frames(self, count=1):
+        with self._lock:
+            self._frames += count
+
+    def snapshot(self):
+        """Return the current metrics as a JSON serializable dict."""
+        now = time.monotonic()
+        with self._lock:
+            stages = {name: {"count": s["count"], "sum": s["sum"], "max": s["max"],
+                             "buckets": np.cumsum(s["buckets"]).tolist()}
+                      for name, s in self._stages.items()}
+            frames = self._frames
+            interval_fps = (frames - self._last_frames) / max(now - self._last_flush, 1e-9)
+            self._last_frames = frames
+            self._last_flush = now
+        return {"time": datetime.datetime.now().isoformat(),
+                "pid": os.getpid(),
+                "uptime": now - self._start,
+                "frames": frames,
+                "fps": frames / max(now - self._start, 1e-9),
+                "interval_fps": interval_fps,
+                "peak_rss_bytes": peak_rss(),
+                "buckets": [str(b) for b in self.BUCKETS],
+                "stages": stages}
+
+    def flush(self):
+        """Write the current metrics to the output file."""
+        path = self.path
+        if os.getpid() != self._pid and path.endswith(".prom"):
+            path = "{}.{}.prom".format(path[:-len(".prom")], os.getpid())
+        with self._flush_lock:
+            snapshot = self.snapshot()
+            try:
+                if path.endswith(".prom"):
+                    # Replace atomically so a scraper never reads a partial
+                    # file. The temporary name is unique per thread too.
+                    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(),
+                                                     threading.get_ident())
+                    with open(tmp_path, "w") as f:
+                        f.write(self._prometheus(snapshot))
+                    os.replace(tmp_path, path)
+                else:
+                    with open(path, "a") as f:
+                        f.write(json.dumps(snapshot) + "\n")
+            except OSError as e:
+                print("Could not write metrics to {}: {}".format(path, e))
+
+    def _prometheus(self, snapshot):
+        lines = ["# TYPE birds_stage_seconds histogram"]
+        for name, s in sorted(snapshot["stages"].items()):
+            for bound, count in zip(self.BUCKETS, s["buckets"]):
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('birds_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                    name, le, count))
+            lines.append('birds_stage_seconds_sum{{stage="{}"}} {}'.format(name, s["sum"]))
+            lines.append('birds_stage_seconds_count{{stage="{}"}} {}'.format(name, s["count"]))
+        lines += ["# TYPE birds_frames_total counter",
+                  "birds_frames_total {}".format(snapshot["frames"]),
+                  "# TYPE birds_fps gauge",
+                  "birds_fps {}".format(snapshot["interval_fps"]),
+                  "# TYPE birds_peak_rss_bytes gauge",
+                  "birds_peak_rss_bytes {}".format(snapshot["peak_rss_bytes"])]
+        return "\n".join(lines) + "\n"
+
+
+class _StageTimer(object):
+    """Context manager returned by Metrics.stage()."""
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes, or None
+    where the resource module isn't available.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+# Metrics of this process. Replaced by enable_metrics().
+METRICS = NullMetrics()
+
+
+def enable_metrics(path, interval=10.0):
+    """Start recording metrics to path, see Metrics."""
+    global METRICS
+    METRICS = Metrics(path, interval)
+    atexit.register(METRICS.flush)
+    return METRICS
+
+
+class TimedAugmenter(object):
+    """Wraps an imgaug augmenter to record augmentation as a stage.
+    Mask R-CNN calls to_deterministic() and then augment_image() on the
+    image and its masks, so those are the calls that are timed.
+    """
+
+    def __init__(self, augmenter):
+        self.augmenter = augmenter
+
+    def to_deterministic(self):
+        return TimedAugmenter(self.augmenter.to_deterministic())
+
+    def augment_image(self, *args, **kwargs):
+        with METRICS.stage("augmentation"):
+            return self.augmenter.augment_image(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # Only reached for attributes the wrapper lacks. While unpickling,
+        # e.g. in spawned data loader workers, augmenter isn't set yet and
+        # pickle probes dunder methods, which mustn't recurse.
+        if name == "augmenter" or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.augmenter, name)
+
+
+############################################################
+#  Annotation index
+############################################################
+
+# Name of the index file that load_birds() keeps in each subset directory
+BIRDS_INDEX_FILE = ".birds_index.pkl"
+
+# Bump when the layout of index records changes
+BIRDS_INDEX_VERSION = 3
+
+# Annotation files of a subset. Annotators can add files next to
+# via_region_data.json, e.g. via_region_data_0001.json, instead of
+# editing one large file.
+ANNOTATION_FILE = "via_region_data.json"
+ANNOTATION_FILES = "via_region_data_*.json"
+
+
+def file_stamp(path):
+    """Return a (mtime, size) tuple used to detect changes to a file."""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _jpeg_size(f):
+    """Scan JPEG markers up to the first SOF segment.
+    Returns (height, width) or None if the header can't be parsed.
+    """
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        while byte and byte != b"\xff":
+            byte = f.read(1)
+        while byte == b"\xff":
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Standalone markers without a payload
+            continue
+        if marker in (0xD9, 0xDA):
+            # End of image or start of scan before any frame header
+            return None
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack(">H", length)[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            _, height, width = struct.unpack(">BHH", data)
+            # A zero height means it's defined later in a DNL segment
+            return (height, width) if height else None
+        f.seek(length - 2, 1)
+
+
+def image_size(path):
+    """Return the (height, width) of an image.
+
+    JPEG and PNG sizes are read from the file header without decoding the
+    image. Other formats fall back to a full decode.
+    """
+    import skimage.io
+    with open(path, "rb") as f:
+        head = f.read(24)
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            width, height = struct.unpack(">II", head[16:24])
+            return height, width
+        if head[:2] == b"\xff\xd8":
+            size = _jpeg_size(f)
+            if size:
+                return size
+    image = skimage.io.imread(path)
+    return image.shape[:2]
+
+
+def annotation_files(dataset_dir):
+    """Return the paths of the annotation files of a subset directory, in
+    merge order: via_region_data.json first, if present, then the added
+    files sorted by name.
+    """
+    base = os.path.join(dataset_dir, ANNOTATION_FILE)
+    paths = [base] if os.path.isfile(base) else []
+    paths += sorted(glob.glob(os.path.join(glob.escape(dataset_dir), ANNOTATION_FILES)))
+    if not paths:
+        raise FileNotFoundError("No {} or {} in {}".format(
+            ANNOTATION_FILE, ANNOTATION_FILES, dataset_dir))
+    return paths
+
+
+def iter_via_annotations(path, chunk_size=1024 ** 2):
+    """Yield the entries of a VIA annotation file one at a time.
+
+    The file is a JSON object that maps a key per image to its entry.
+    Rather than loading it whole, which takes several times the file size
+    in memory, it's read in chunks and each entry is decoded with
+    json.JSONDecoder.raw_decode() as soon as it's complete. Memory use is
+    bounded by the largest entry plus one chunk.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buf, pos, eof = "", 0, False
+
+        def fill():
+            # Drop what's been consumed and read another chunk
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            return not eof
+
+        def skip_space():
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos].isspace():
+                    pos += 1
+                if pos < len(buf) or not fill():
+                    return buf[pos] if pos < len(buf) else ""
+
+        def decode():
+            nonlocal pos
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # Most likely cut off at the end of the chunk
+                    if fill():
+                        continue
+                    raise
+                # A value that ends the buffer may continue in the next chunk
+                if end == len(buf) and fill():
+                    continue
+                pos = end
+                return value
+
+        def expect(chars):
+            nonlocal pos
+            c = skip_space()
+            if not c or c not in chars:
+                raise ValueError("Malformed VIA annotation file {}: expected "
+                                 "{!r}, found {!r}".format(path, chars, c))
+            pos += 1
+            return c
+
+        expect("{")
+        if skip_space() == "}":
+            return
+        while True:
+            skip_space()
+            decode()  # The key, which is the file name and size
+            expect(":")
+            skip_space()
+            yield decode()
+            if expect(",}") == "}":
+                return
+
+
+def parse_annotation(annotation):
+    """Extract the polygons and class IDs of one VIA annotation entry.
+    Returns an index record without the image size. The vertices of all
+    polygons are concatenated into the "x" and "y" arrays, and "lengths"
+    holds the number of vertices of each polygon.
+    """
+    # Get the x, y coordinaets of points of the polygons that make up
+    # the outline of each object instance. There are stores in the
+    # shape_attributes (see json format in load_birds())
+    if type(annotation['regions']) is dict:
+        regions = list(annotation['regions'].values())
+    else:
+        regions = annotation['regions']
+    # Regions that can't be rasterized are dropped, along with their IDs
+    regions = [r for r in regions if is_valid_polygon(r['shape_attributes'])]
+    polygons = [r['shape_attributes'] for r in regions]
+    num_ids = [int(r['region_attributes']['birds']) for r in regions]
+    return {"filename": annotation['filename'],
+            "x": np.array([x for p in polygons for x in p['all_points_x']],
+                          dtype=np.float32),
+            "y": np.array([y for p in polygons for y in p['all_points_y']],
+                          dtype=np.float32),
+            "lengths": np.array([len(p['all_points_x']) for p in polygons],
+                                dtype=np.int64),
+            "class_ids": np.array(num_ids, dtype=np.int32)}
+
+
+def is_valid_polygon(shape):
+    """Check that a VIA shape is a polygon with at least 3 vertices."""
+    xs = shape.get('all_points_x')
+    ys = shape.get('all_points_y')
+    return (xs is not None and ys is not None and
+            len(xs) == len(ys) and len(xs) >= 3)
+
+
+def probe_record(dataset_dir, record, cached=None):
+    """Add the image size to an index record.
+
+    load_mask() needs the image size to convert polygons to masks, and
+    VIA doesn't include it in the JSON. The size is read from the image
+    header, or taken from the cached record if the image didn't change.
+    """
+    image_path = os.path.join(dataset_dir, record['filename'])
+    stamp = file_stamp(image_path)
+    if cached is not None and cached.get('stamp') == stamp:
+        height, width = cached['height'], cached['width']
+    else:
+        height, width = image_size(image_path)
+    return dict(record, height=height, width=width, stamp=stamp)
+
+
+def parse_annotations(annotations):
+    """Parse VIA annotation entries into index records without image
+    sizes, see parse_annotation(). Entries without valid polygons are
+    skipped.
+    """
+    records = []
+    for annotation in annotations:
+        # The VIA tool saves images in the JSON even if they don't have any
+        # annotations. Skip unannotated images.
+        if not annotation['regions']:
+            continue
+        record = parse_annotation(annotation)
+        if len(record['class_ids']):
+            records.append(record)
+    return records
+
+
+def parse_annotation_file(path, workers=0, chunk_entries=1000):
+    """Parse a VIA annotation file entry by entry.
+    workers: Number of processes that parse the entries. The file is
+        still decoded in the calling process, and chunks of chunk_entries
+        entries are parsed in the pool while the next ones are decoded.
+        At most two chunks per worker are in flight, which keeps memory
+        bounded.
+    Returns index records, see parse_annotations().
+    """
+    annotations = iter_via_annotations(path)
+    if workers is None or workers <= 1:
+        return parse_annotations(annotations)
+    records = []
+    in_flight = collections.deque()
+    # Spawn rather than fork, see map_ordered()
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as executor:
+        for chunk in batched(annotations, chunk_entries):
+            if len(in_flight) >= 2 * workers:
+                records += in_flight.popleft().result()
+            in_flight.append(executor.submit(parse_annotations, chunk))
+        while in_flight:
+            records += in_flight.popleft().result()
+    return records
+
+
+def map_ordered(func, *iterables, workers=0):
+    """Like map(), but runs on a process pool if workers > 1.
+    Results are returned as a list in the order of the inputs.
+    """
+    items = [list(i) for i in iterables]
+    if workers is None or workers <= 1 or not items[0]:
+        return list(map(func, *items))
+    # A few chunks per worker keeps the pool balanced without paying
+    # the IPC cost for every single item.
+    chunksize = max(1, len(items[0]) // (workers * 4))
+    # Spawn rather than fork, since the caller may already have
+    # initialized TensorFlow, and forking that isn't safe.
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as executor:
+        return list(executor.map(func, *items, chunksize=chunksize))
+
+
+def pack_records(records):
+    """Split index records into per-image metadata and flat polygon arrays.
+
+    Returns:
+    images: List of dicts with the file name, size and stamp of each image,
+        and its number of instances.
+    polygons: Dict of arrays shared by all images. "x" and "y" hold the
+        vertices of all polygons, "lengths" the vertex count of each
+        polygon and "class_ids" its class ID. Polygons are stored in image
+        order.
+    """
+    images = [{"filename": r['filename'], "height": r['height'],
+               "width": r['width'], "stamp": r['stamp'],
+               "instances": len(r['class_ids'])} for r in records]
+    polygons = {}
+    for key, dtype in [("x", np.float32), ("y", np.float32),
+                       ("lengths", np.int64), ("class_ids", np.int32)]:
+        polygons[key] = np.concatenate(
+            [np.zeros([0], dtype)] + [r[key] for r in records])
+    return images, polygons
+
+
+def merge_annotation_files(files):
+    """Merge the images and polygons of several annotation files.
+    files: List of dicts with the "stamp", "images" and "polygons" of each
+        file, as returned by pack_records().
+
+    An image annotated in more than one file takes its annotations from
+    the last one. Returns (images, polygons) like pack_records(), with
+    the stamp of the source file in the "annotations" entry of each image.
+    """
+    last = {}
+    for i, f in enumerate(files):
+        for j, image in enumerate(f['images']):
+            last[image['filename']] = (i, j)
+    images = []
+    polygons = {key: [] for key in ["x", "y", "lengths", "class_ids"]}
+    for i, f in enumerate(files):
+        keep = np.array([last[image['filename']] == (i, j)
+                         for j, image in enumerate(f['images'])], dtype=bool)
+        images += [dict(image, annotations=f['stamp'])
+                   for image, k in zip(f['images'], keep) if k]
+        p = f['polygons']
+        if not keep.all():
+            # Expand the image mask to polygons, and polygons to vertices
+            instances = [image['instances'] for image in f['images']]
+            keep_polygons = np.repeat(keep, instances)
+            keep_vertices = np.repeat(keep_polygons, p['lengths'])
+            p = {"x": p['x'][keep_vertices], "y": p['y'][keep_vertices],
+                 "lengths": p['lengths'][keep_polygons],
+                 "class_ids": p['class_ids'][keep_polygons]}
+        for key in polygons:
+            polygons[key].append(p[key])
+    polygons = {key: np.concatenate(arrays) for key, arrays in polygons.items()}
+    return images, polygons
+
+
+def load_birds_index(index_path):
+    """Load an annotation index saved by save_birds_index().
+    Returns None if the file is missing, unreadable or outdated.
+    """
+    try:
+        with open(index_path, "rb") as f:
+            index = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if not isinstance(index, dict) or index.get('version') != BIRDS_INDEX_VERSION:
+        return None
+    return index
+
+
+def save_birds_index(index_path, files):
+    """Save the index records of each annotation file.
+    files: List of dicts with the "name", "stamp", "images" and "polygons"
+        of each annotation file.
+
+    The file is replaced atomically so concurrent readers never see a
+    partial index. Failures are reported, not raised, since the index is
+    only a cache.
+    """
+    index = {"version": BIRDS_INDEX_VERSION,
+             "files": files}
+    tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print("Could not save annotation index {}: {}".format(index_path, e))
+
+
+
+def crop_masks(mask):
+    """Crop each instance of a mask to its bounding box.
+    mask: [height, width, instance count] array.
+
+    Returns (boxes, masks) in the format of BirdsDataset.load_mask_cropped().
+    Empty instances get a zero-size box.
+    """
+    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
+    masks = []
+    for i in range(mask.shape[-1]):
+        m = mask[:, :, i].astype(bool)
+        rows = np.flatnonzero(m.any(axis=1))
+        cols = np.flatnonzero(m.any(axis=0))
+        if rows.size:
+            boxes[i] = [rows[0], cols[0], rows[-1] + 1, cols[-1] + 1]
+        y1, x1, y2, x2 = boxes[i]
+        masks.append(m[y1:y2, x1:x2])
+    return boxes, masks
+
+
+def expand_cropped_masks(boxes, masks, shape, dtype=np.uint8):
+    """Paste cropped instance masks into a full size mask.
+    boxes, masks: As returned by BirdsDataset.load_mask_cropped().
+    shape: (height, width) of the image.
+
+    Returns: [height, width, instance count] array.
+    """
+    mask = np.zeros(tuple(shape) + (len(masks),), dtype=dtype)
+    for i, ((y1, x1, y2, x2), m) in enumerate(zip(boxes, masks)):
+        mask[y1:y2, x1:x2, i] = m
+    return mask
+
+
+############################################################
+#  Mask cache
+############################################################
+
+def pack_masks(masks):
+    """Bit-pack a list of bool masks into one uint8 array. Each mask is
+    padded to a whole number of bytes.
+    """
+    packed = [np.packbits(m.ravel()) for m in masks]
+    return np.concatenate([np.zeros([0], np.uint8)] + packed)
+
+
+def unpack_masks(data, shapes):
+    """Unpack masks packed by pack_masks().
+    data: uint8 array, e.g. a memory-mapped slice of a file.
+    shapes: (height, width) of each mask.
+
+    Returns a list of bool masks, or None if data doesn't match the shapes.
+    """
+    sizes = [h * w for h, w in shapes]
+    if data.shape != ((sum((s + 7) // 8 for s in sizes)),):
+        return None
+    masks = []
+    offset = 0
+    for (h, w), size in zip(shapes, sizes):
+        nbytes = (size + 7) // 8
+        bits = np.unpackbits(data[offset:offset + nbytes], count=size)
+        masks.append(bits.view(bool).reshape(h, w))
+        offset += nbytes
+    return masks
+
+
+class MaskCache(object):
+    """Persistent cache of rasterized instance masks.
+
+    Each image's cropped masks (see BirdsDataset.load_mask_cropped()) are
+    bit-packed into one .npy file, which is memory-mapped when read, so
+    data loader processes share the page cache instead of each holding a
+    copy. The bounding boxes aren't stored since they're cheap to
+    recompute from the polygons, and they give the shape of each mask.
+
+    Entries are keyed by the image and the annotation file stamp, so
+    editing the annotations invalidates them. When the cache grows past
+    max_bytes, the least recently used entries are deleted until it is
+    back under LOW_WATER of max_bytes. Recency is
+    tracked through file mtimes, which works across processes.
+    """
+
+    # Fraction of max_bytes that eviction trims the cache down to
+    LOW_WATER = 0.9
+
+    def __init__(self, cache_dir, max_bytes=4 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """Rebuild the LRU order from the files in the cache directory."""
+        entries = []
+        for e in os.scandir(self.cache_dir):
+            if e.name.endswith(".npy"):
+                try:
+                    stat = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, e.name, stat.st_size))
+        entries.sort()
+        self._sizes = collections.OrderedDict((n, s) for _, n, s in entries)
+        self._total = sum(self._sizes.values())
+
+    @staticmethod
+    def key(info):
+        """Return the cache entry name of an image_info entry."""
+        data = repr((info["path"], info["height"], info["width"],
+                     info.get("annotations")))
+        return hashlib.sha1(data.encode("utf-8")).hexdigest() + ".npy"
+
+    def get(self, key, shapes):
+        """Read the masks of an entry.
+        shapes: (height, width) of each mask.
+        Returns a list of bool masks, or None if the entry is missing or
+        doesn't match the shapes.
+        """
+        path = os.path.join(self.cache_dir, key)
+        try:
+            data = np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        masks = unpack_masks(data, shapes)
+        if masks is None:
+            return None
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        if key in self._sizes:
+            self._sizes.move_to_end(key)
+        return masks
+
+    def put(self, key, masks):
+        """Store the masks of an entry and evict old entries if needed."""
+        data = pack_masks(masks)
+        path = os.path.join(self.cache_dir, key)
+        # Write to a temporary file and rename, so readers never map a
+        # partially written entry.
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, data)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            print("Could not write mask cache entry {}: {}".format(path, e))
+            return
+        self._total += size - self._sizes.pop(key, 0)
+        self._sizes[key] = size
+        if self._total > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """Delete least recently used entries until under LOW_WATER of
+        max_bytes. Leaving headroom means the directory is only rescanned
+        once per many misses, not on every put() of a full cache.
+        """
+        # Other processes add entries too, so refresh from disk first
+        self._scan()
+        target = self.max_bytes * self.LOW_WATER
+        while self._total > target and self._sizes:
+            key, size = self._sizes.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, key))
+            except FileNotFoundError:
+                pass
+
+
+############################################################
+#  Shards
+############################################################
+
+# Shard files start with this header: magic, version, and the offset and
+# size of the pickled index at the end of the file.
+SHARD_MAGIC = b"BIRDSHRD"
+SHARD_VERSION = 1
+SHARD_HEADER = struct.Struct("<8sIQQ")
+
+
+class ShardWriter(object):
+    """Writes a dataset split into a few large shard files.
+
+    Reading many small files is slow on network storage, and rasterizing
+    polygons costs CPU on every epoch. A shard holds the images and the
+    bit-packed cropped masks (see pack_masks()) of many images back to
+    back, followed by an index with their offsets, sizes, boxes and class
+    IDs. BirdsDataset.load_shards() reads them through memory maps.
+
+    output_dir: Directory for the shards, which are named
+        <subset>-00000.shard, <subset>-00001.shard, ...
+    shard_bytes: A new shard is started once the current one is larger.
+    decoded: Store images as raw RGB pixels rather than the original
+        files. Bigger, but images are read without decoding or copying.
+    """
+
+    def __init__(self, output_dir, subset, shard_bytes=1024 ** 3, decoded=False):
+        self.output_dir = output_dir
+        self.subset = subset
+        self.shard_bytes = shard_bytes
+        self.decoded = decoded
+        self.paths = []
+        self._file = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def add(self, filename, path, height, width, image, boxes, masks, class_ids):
+        """Append one image.
+        image: RGB image array if decoded, else the bytes of the image file.
+        boxes, masks, class_ids: As returned by load_mask_cropped().
+        """
+        if self._file is None:
+            self._open()
+        if self.decoded:
+            image = np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+        index = self._index
+        index["image_offsets"].append(self._file.tell())
+        index["image_sizes"].append(len(image))
+        self._file.write(image)
+        index["mask_offsets"].append(self._file.tell())
+        self._file.write(pack_masks(masks).tobytes())
+        index["filenames"].append(filename)
+        index["paths"].append(path)
+        index["shapes"].append((height, width))
+        index["instances"].append(index["instances"][-1] + len(class_ids))
+        index["boxes"].append(np.asarray(boxes, dtype=np.int32).reshape(-1, 4))
+        index["class_ids"].append(np.asarray(class_ids, dtype=np.int32))
+        if self._file.tell() >= self.shard_bytes:
+            self._finish()
+
+    def add_dataset(self, dataset):
+        """Append all images of a prepared dataset."""
+        for image_id in dataset.image_ids:
+            info = dataset.image_info[image_id]
+            if self.decoded:
+                image = dataset.load_image(image_id)
+            else:
+                with open(info["path"], "rb") as f:
+                    image = f.read()
+            boxes, masks, class_ids = dataset.load_mask_cropped(image_id)
+            self.add(info["id"], info["path"], info["height"], info["width"],
+                     image, boxes, masks, class_ids)
+
+    def close(self):
+        """Finish the last shard. Returns the paths of all shards."""
+        if self._file is not None:
+            self._finish()
+        return self.paths
+
+    def _open(self):
+        self._path = os.path.join(self.output_dir, "{}-{:05d}.shard".format(
+            self.subset, len(self.paths)))
+        self._file = open(self._path + ".tmp", "wb")
+        self._file.write(SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION, 0, 0))
+        self._index = {"filenames": [], "paths": [], "shapes": [],
+                       "image_offsets": [], "image_sizes": [], "mask_offsets": [],
+                       "instances": [0], "boxes": [], "class_ids": []}
+
+    def _finish(self):
+        lists = self._index
+        index = {"version": SHARD_VERSION,
+                 "decoded": self.decoded,
+                 "filenames": lists["filenames"],
+                 "paths": lists["paths"],
+                 "shapes": np.array(lists["shapes"], dtype=np.int64).reshape(-1, 2),
+                 "image_offsets": np.array(lists["image_offsets"], dtype=np.int64),
+                 "image_sizes": np.array(lists["image_sizes"], dtype=np.int64),
+                 "mask_offsets": np.array(lists["mask_offsets"], dtype=np.int64),
+                 "instances": np.array(lists["instances"], dtype=np.int64),
+                 "boxes": np.concatenate([np.zeros([0, 4], np.int32)] + lists["boxes"]),
+                 "class_ids": np.concatenate([np.zeros([0], np.int32)] + lists["class_ids"])}
+        data = pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL)
+        index_offset = self._file.tell()
+        self._file.write(data)
+        self._file.seek(0)
+        self._file.write(SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION,
+                                           index_offset, len(data)))
+        self._file.close()
+        self._file = None
+        # Rename once complete, so readers never see a partial shard
+        os.replace(self._path + ".tmp", self._path)
+        self.paths.append(self._path)
+
+
+def read_shard_index(path):
+    """Read the index of a shard written by ShardWriter."""
+    with open(path, "rb") as f:
+        header = f.read(SHARD_HEADER.size)
+        if len(header) == SHARD_HEADER.size:
+            magic, version, index_offset, index_size = SHARD_HEADER.unpack(header)
+        if len(header) != SHARD_HEADER.size or magic != SHARD_MAGIC:
+            raise ValueError("Not a birds shard: {}".format(path))
+        if version != SHARD_VERSION:
+            raise ValueError("Unsupported shard version {}: {}".format(version, path))
+        f.seek(index_offset)
+        return pickle.loads(f.read(index_size))
+
+
+def pack_birds(dataset, output_dir, subset, shard_bytes=1024 ** 3, decoded=False):
+    """Pack a prepared BirdsDataset split into shards.
+    Returns the paths of the shards.
+    """
+    writer = ShardWriter(output_dir, subset, shard_bytes, decoded)
+    writer.add_dataset(dataset)
+    paths = writer.close()
+    print("Packed {} {} images into {} shards in {}".format(
+        len(dataset.image_ids), subset, len(paths), output_dir))
+    return paths
+
+
 ############################################################
 #  Dataset
 ############################################################
-class BirdsDataset(utils.Dataset):
-    def load_birds(self, dataset_dir, subset):
+class BirdsDatasetMixin(object):
+    """Methods of BirdsDataset.
+
+    BirdsDataset combines them with utils.Dataset when it's first
+    accessed, see birds_dataset_class(), so that importing this module
+    doesn't import TensorFlow through mrcnn.utils.
+    """
+
+    def __init__(self, class_map=None):
+        super().__init__(class_map)
+        # Polygons of all images are kept in flat arrays rather than in
+        # per-image lists, which is much smaller and is shared copy-on-write
+        # with forked data loader processes. Polygon i has the vertices
+        # polygon_x/y[polygon_offsets[i]:polygon_offsets[i + 1]], and the
+        # polygons of an image are the range in its "instances" entry.
+        self.polygon_x = np.zeros([0], dtype=np.float32)
+        self.polygon_y = np.zeros([0], dtype=np.float32)
+        self.polygon_offsets = np.zeros([1], dtype=np.int64)
+        self.polygon_class_ids = np.zeros([0], dtype=np.int32)
+        # Optional MaskCache, see enable_mask_cache()
+        self.mask_cache = None
+        # Shards added by load_shards(), as (path, index) pairs, and their
+        # memory maps, which are opened on first use in each process
+        self.shards = []
+        self._shard_data = {}
+
+    def __getstate__(self):
+        # Memory maps would be pickled as copies of the whole shard, so
+        # worker processes open their own instead
+        state = self.__dict__.copy()
+        state["_shard_data"] = {}
+        return state
+
+    def enable_mask_cache(self, cache_dir, max_bytes=4 * 1024 ** 3):
+        """Keep rasterized masks in a persistent MaskCache in cache_dir,
+        so they're computed once rather than on every epoch.
+        """
+        self.mask_cache = MaskCache(cache_dir, max_bytes)
+
+    def add_polygons(self, polygons):
+        """Append flat polygon arrays as returned by pack_records().
+        Returns the index of the first added polygon.
+        """
+        first = len(self.polygon_class_ids)
+        offsets = self.polygon_offsets[-1] + np.cumsum(polygons['lengths'])
+        self.polygon_x = np.concatenate([self.polygon_x, polygons['x']])
+        self.polygon_y = np.concatenate([self.polygon_y, polygons['y']])
+        self.polygon_offsets = np.concatenate([self.polygon_offsets, offsets])
+        self.polygon_class_ids = np.concatenate(
+            [self.polygon_class_ids, polygons['class_ids']])
+        return first
+
+    def load_birds(self, dataset_dir, subset, use_index=True, index_path=None,
+                   workers=0):
 
         """Load a subset of the Balloon dataset.
         dataset_dir: Root directory of the dataset.
         subset: Subset to load: train or val
+        use_index: If True, reuse and update the on-disk annotation index.
+        index_path: Path of the index file. Defaults to a file in the
+            subset directory.
+        workers: Number of processes used to parse annotations and probe
+            images. 0 or 1 runs everything in the calling process.
         """
-        # Add classes. We have only one class to add.
-        self.add_class("birds", 1, "Acadian_Flycatcher")
-        self.add_class("birds", 2, "American_Crow")
-        self.add_class("birds", 3, "American_Goldfinch")
-        self.add_class("birds", 4, "Anna_Hummingbird")
-        self.add_class("birds", 5, "Baltimore_Oriole")
-        self.add_class("birds", 6, "Belted_Kingfisher")
-        self.add_class("birds", 7, "Black_Billed_Cuckoo")
-        self.add_class("birds", 8, "Black_Footed_Albatross")
-        self.add_class("birds", 9, "Blue_Grosbeak")
-        self.add_class("birds", 10, "Blue_Jay")
-        self.add_class("birds", 11, "Boat_Tailed_Grackle")
-        self.add_class("birds", 12, "Bobolink") 
-        self.add_class("birds", 13, "Brandt_Cormorant")
-        self.add_class("birds", 14, "Brewer_Blackbird")
-        self.add_class("birds", 15, "Bronzed_Cowbird")
-        self.add_class("birds", 16, "Brown_Creeper")
-        self.add_class("birds", 17, "Brown_Pelican")
-        self.add_class("birds", 18, "California_Gull")
-        self.add_class("birds", 19, "Cardinal")
-        self.add_class("birds", 20, "Chuck_Will_Widow")
-        self.add_class("birds", 21, "Clark_Nutcracker")
-        self.add_class("birds", 22, "Crested_Auklet")
-        self.add_class("birds", 23, "Dark_Eyed_Junco")
-        self.add_class("birds", 24, "Eared_Grebe")
-        self.add_class("birds", 25, "Eastern_Towhee")
-        self.add_class("birds", 26, "European_Goldfinch")
-        self.add_class("birds", 27, "Evening_Grosbeak")
-        self.add_class("birds", 28, "Fish_Crow")
-        self.add_class("birds", 29, "Florida_Jay")
-        self.add_class("birds", 30, "Frigatebird")
-        self.add_class("birds", 31, "Gadwall")
-        self.add_class("birds", 32, "Glaucous_Winged_Gul")
-        self.add_class("birds", 33, "Gray_Catbird")
-        self.add_class("birds", 34, "Gray_Crowned_Rosy_Finch")
-        self.add_class("birds", 35, "Gray_Kingbird")
-        self.add_class("birds", 36, "Great_Crested_Flycatcher")
-        self.add_class("birds", 37, "Green_Jay")
-        self.add_class("birds", 38, "Green_Kingfisher")
-        self.add_class("birds", 39, "Green_Violetear")
-        self.add_class("birds", 40, "Groove_Billed_Ani")
-        self.add_class("birds", 41, "Heermann_Gull")
-        self.add_class("birds", 42, "Herring_Gull")
-        self.add_class("birds", 43, "Hooded_Merganser")
-        self.add_class("birds", 44, "Hooded_Oriole") 
-        self.add_class("birds", 45, "Horned_Grebe")
-        self.add_class("birds", 46, "Horned_Lark")
-        self.add_class("birds", 47, "Indigo_Bunting")
-        self.add_class("birds", 48, "Ivory_Gull")
-        self.add_class("birds", 49, "Laysan_Albatross")
-        self.add_class("birds", 50, "Lazuli_Bunting")
-        self.add_class("birds", 51, "Least_Auklet")
-        self.add_class("birds", 52, "Least_Flycatcher")
-        self.add_class("birds", 53, "Long_Tailed_Jaeger")
-        self.add_class("birds", 54, "Mallard")
-        self.add_class("birds", 55, "Mangrove_Cuckoo")
-        self.add_class("birds", 56, "Mockingbird")
-        self.add_class("birds", 57, "Nighthawk")
-        self.add_class("birds", 58, "Northern_Flicker")
-        self.add_class("birds", 59, "Northern_Fulmar")
-        self.add_class("birds", 60, "Olive_Sided_Flycatcher")
-        self.add_class("birds", 61, "Orchard_Oriole")
-        self.add_class("birds", 62, "Ovenbird")
-        self.add_class("birds", 63, "Pacific_Loon")
-        self.add_class("birds", 64, "Painted_Bunting")
-        self.add_class("birds", 65, "Parakeet_Auklet")
-        self.add_class("birds", 66, "Pelagic_Cormorant")
-        self.add_class("birds", 67, "Pied_Billed_Grebe") 
-        self.add_class("birds", 68, "Pied_Kingfisher") 
-        self.add_class("birds", 69, "Pigeon_Guillemot") 
-        self.add_class("birds", 70, "Pine_Grosbeak") 
-        self.add_class("birds", 71, "Pomarine_Jaeger") 
-        self.add_class("birds", 72, "Purple_Finch") 
-        self.add_class("birds", 73, "Red_Breasted_Merganser")        
-        self.add_class("birds", 74, "Red_Faced_Cormorant") 
-        self.add_class("birds", 75, "Red_Legged_Kittiwake") 
-        self.add_class("birds", 76, "Red_Winged_Blackbird") 
-        self.add_class("birds", 77, "Rhinoceros_Auklet") 
-        self.add_class("birds", 78, "Ring_Billed_Gull") 
-        self.add_class("birds", 79, "Ringed_Kingfisher") 
-        self.add_class("birds", 80, "Rose_Breasted_Grosbeak") 
-        self.add_class("birds", 81, "Ruby_Throated_Hummingbird") 
-        self.add_class("birds", 82, "Rufous_Humming") 
-        self.add_class("birds", 83, "Rusty_Blackbird") 
-        self.add_class("birds", 84, "Scissor_Tailed_Flycatcher") 
-        self.add_class("birds", 85, "Scott_Oriole") 
-        self.add_class("birds", 86, "Shiny_Cowbird") 
-        self.add_class("birds", 87, "Slaty_Backed_Gull") 
-        self.add_class("birds", 88, "Sooty_Albatross") 
-        self.add_class("birds", 89, "Spotted_Catbird") 
-        self.add_class("birds", 90, "Tropical_Kingbird") 
-        self.add_class("birds", 91, "Vermilion_Flycatcher") 
-        self.add_class("birds", 92, "Western_Grebe") 
-        self.add_class("birds", 93, "Western_Gull") 
-        self.add_class("birds", 94, "Western_Meadowlark") 
-        self.add_class("birds", 95, "White_Breasted_Kingfisher") 
-        self.add_class("birds", 96, "White_Breasted_Nuthatch") 
-        self.add_class("birds", 97, "Yellow_Bellied_Flycatcher") 
-        self.add_class("birds", 98, "Yellow_Billed_Cuckoo") 
-        self.add_class("birds", 99, "Yellow_Breasted_Chat") 
-        self.add_class("birds", 100, "Yellow_Headed_Blackbird") 
-        
+        # Add classes
+        for class_id, name in enumerate(BIRD_CLASSES, 1):
+            self.add_class("birds", class_id, name)
 
         # Train or validation dataset?
         assert subset in ["train", "val"]
@@ -206,40 +1135,106 @@ class BirdsDataset(utils.Dataset):
         #   },
         #   'size': 100202
         # }
-        # We mostly care about the x and y coordinates of each region
-        annotations = json.load(open(os.path.join(dataset_dir, "via_region_data.json")))
-        annotations = list(annotations.values())  # don't need the dict keys
+        # We mostly care about the x and y coordinates of each region.
+        # The annotations may be split over several files, see
+        # annotation_files(), which are parsed one entry at a time.
+        annotation_paths = annotation_files(dataset_dir)
 
-        # The VIA tool saves images in the JSON even if they don't have any
-        # annotations. Skip unannotated images.
-        annotations = [a for a in annotations if a['regions']]
-
-         # Add images
-        for a in annotations:
-            # Get the x, y coordinaets of points of the polygons that make up
-            # the outline of each object instance. There are stores in the
-            # shape_attributes (see json format above)
-            if type(a['regions']) is dict:
-                polygons = [r['shape_attributes'] for r in a['regions'].values()]
-                objects = [s['region_attributes'] for s in a['regions'].values()]
+        # Parsing the annotations and probing every image is slow on large
+        # datasets, so the result is kept in an index file next to the
+        # annotations. Annotation files that didn't change are reused from
+        # the index, and only their images whose files changed are probed
+        # again. New or changed annotation files are parsed again.
+        if index_path is None:
+            index_path = os.path.join(dataset_dir, BIRDS_INDEX_FILE)
+        index = load_birds_index(index_path) if use_index else None
+        indexed = {f['name']: f for f in index['files']} if index else {}
+        cached = {r['filename']: r for f in indexed.values() for r in f['images']}
+        probe = functools.partial(probe_record, dataset_dir)
+
+        files = []
+        for path in annotation_paths:
+            name, stamp = os.path.basename(path), file_stamp(path)
+            f = indexed.get(name)
+            if f and f['stamp'] == stamp:
+                images = map_ordered(probe, f['images'], f['images'],
+                                     workers=workers)
+                polygons = f['polygons']
             else:
-                polygons = [r['shape_attributes'] for r in a['regions']] 
-                objects = [s['region_attributes'] for s in a['regions']]
+                records = parse_annotation_file(path, workers=workers)
+                records = map_ordered(probe, records,
+                                      [cached.get(r['filename']) for r in records],
+                                      workers=workers)
+                images, polygons = pack_records(records)
+            files.append({"name": name, "stamp": stamp, "images": images,
+                          "polygons": polygons})
+
+        def summary(files):
+            return [(f['name'], f['stamp'], f['images']) for f in files]
 
-            # load_mask() needs the image size to convert polygons to masks.
-            # Unfortunately, VIA doesn't include it in JSON, so we must read
-            num_ids = [int(n['birds']) for n in objects]
-            # the image. This is only managable since the dataset is tiny.
-            image_path = os.path.join(dataset_dir, a['filename'])
-            image = skimage.io.imread(image_path)
-            height, width = image.shape[:2]
+        if use_index and (index is None or summary(index['files']) != summary(files)):
+            save_birds_index(index_path, files)
+        images, polygons = merge_annotation_files(files)
 
+        # Add images
+        start = self.add_polygons(polygons)
+        for r in images:
             self.add_image(
                 "birds",
-                image_id=a['filename'],  # use file name as a unique image id
-                path=image_path,
-                width=width, height=height,
-                polygons=polygons,num_ids=num_ids)
+                image_id=r['filename'],  # use file name as a unique image id
+                path=os.path.join(dataset_dir, r['filename']),
+                width=r['width'], height=r['height'],
+                instances=(start, start + r['instances']),
+                annotations=r['annotations'])
+            start += r['instances']
+
+    def load_shards(self, shard_dir, subset):
+        """Load a subset packed by the pack command, see ShardWriter.
+        shard_dir: Directory of the shards.
+        subset: Subset to load: train or val
+        """
+        # Add classes
+        for class_id, name in enumerate(BIRD_CLASSES, 1):
+            self.add_class("birds", class_id, name)
+
+        paths = sorted(glob.glob(os.path.join(shard_dir, "{}-*.shard".format(subset))))
+        assert paths, "No {} shards in {}".format(subset, shard_dir)
+        for path in paths:
+            index = read_shard_index(path)
+            shard = len(self.shards)
+            self.shards.append((path, index))
+            for i, (filename, image_path) in enumerate(zip(index["filenames"],
+                                                           index["paths"])):
+                height, width = index["shapes"][i]
+                self.add_image(
+                    "birds",
+                    image_id=filename,
+                    path=image_path,
+                    width=int(width), height=int(height),
+                    shard=(shard, i))
+
+    def _shard_entry(self, image_id):
+        """Return (memory map, index, entry number) of a shard image."""
+        shard, i = self.image_info[image_id]["shard"]
+        data = self._shard_data.get(shard)
+        if data is None:
+            data = self._shard_data[shard] = np.memmap(
+                self.shards[shard][0], dtype=np.uint8, mode="r").view(np.ndarray)
+        return data, self.shards[shard][1], i
+
+    def load_image(self, image_id):
+        """Load an image, from its shard if it was loaded by load_shards().
+        Decoded shard images are returned as read-only views of the shard.
+        """
+        info = self.image_info[image_id]
+        if "shard" not in info:
+            return super().load_image(image_id)
+        data, index, i = self._shard_entry(image_id)
+        start = index["image_offsets"][i]
+        image = data[start:start + index["image_sizes"][i]]
+        if index["decoded"]:
+            return image.reshape(info["height"], info["width"], 3)
+        return load_rgb_image(io.BytesIO(image))
 
     def load_mask(self, image_id):
         """Generate instance masks for an image.
@@ -249,26 +1244,92 @@ class BirdsDataset(utils.Dataset):
         class_ids: a 1D array of class IDs of the instance masks.
         """
         # If not a balloon dataset image, delegate to parent class.
-        #image_info = self.image_info[image_id]
         info = self.image_info[image_id]
         if info["source"] != "birds":
-            return super(self.__class__, self).load_mask(image_id)
-        num_ids = info['num_ids']
-        # Convert polygons to a bitmap mask of shape
-        # [height, width, instance_count]
-        #info = self.image_info[image_id]
-        mask = np.zeros([info["height"], info["width"], len(info["polygons"])],
-                        dtype=np.uint8)
-
-        for i, p in enumerate(info["polygons"]):
-            # Get indexes of pixels inside the polygon and set them to 1
-            rr, cc = skimage.draw.polygon(p['all_points_y'], p['all_points_x'])
-            mask[rr, cc, i] = 1
-
-        # Return mask, and array of class IDs of each instance. Since we have
-        # one class ID only, we return an array of 1s
-        num_ids = np.array(num_ids, dtype=np.int32)
-        return mask, num_ids
+            return super().load_mask(image_id)
+        # Rasterize each instance within its bounding box, then paste the
+        # crops into a bitmap mask of shape [height, width, instance_count]
+        with METRICS.stage("load_mask"):
+            boxes, masks, class_ids = self.load_mask_cropped(image_id)
+            mask = expand_cropped_masks(boxes, masks, (info["height"], info["width"]))
+        return mask, class_ids
+
+    def instance_boxes(self, image_id):
+        """Compute the bounding boxes of the instances of an image from
+        their polygon vertices.
+
+        Returns: int32 array [instance count, (y1, x1, y2, x2)], clipped to
+        the image. y2 and x2 are exclusive, so a box covers every pixel that
+        skimage.draw.polygon() can fill.
+        """
+        info = self.image_info[image_id]
+        if "shard" in info:
+            _, index, i = self._shard_entry(image_id)
+            start, stop = index["instances"][i:i + 2]
+            return index["boxes"][start:stop]
+        start, stop = info["instances"]
+        if start == stop:
+            return np.zeros([0, 4], dtype=np.int32)
+        a, b = self.polygon_offsets[start], self.polygon_offsets[stop]
+        # Offsets of each polygon relative to the first vertex of the image
+        offsets = self.polygon_offsets[start:stop] - a
+        ys, xs = self.polygon_y[a:b], self.polygon_x[a:b]
+        boxes = np.stack([np.floor(np.minimum.reduceat(ys, offsets)),
+                          np.floor(np.minimum.reduceat(xs, offsets)),
+                          np.ceil(np.maximum.reduceat(ys, offsets)) + 1,
+                          np.ceil(np.maximum.reduceat(xs, offsets)) + 1], axis=1)
+        limits = [info["height"], info["width"]] * 2
+        return np.clip(boxes, 0, limits).astype(np.int32)
+
+    def load_mask_cropped(self, image_id):
+        """Generate instance masks cropped to the bounding box of each
+        instance. Much cheaper than load_mask() when objects are small
+        compared to the image.
+
+        Returns:
+        boxes: int32 array [instance count, (y1, x1, y2, x2)]. y2 and x2 are
+            exclusive.
+        masks: List of bool arrays, one [y2 - y1, x2 - x1] mask per instance.
+        class_ids: a 1D array of class IDs of the instance masks.
+        """
+        import skimage.draw
+        info = self.image_info[image_id]
+        if info["source"] != "birds":
+            mask, class_ids = super().load_mask(image_id)
+            return crop_masks(mask) + (class_ids,)
+        if "shard" in info:
+            data, index, i = self._shard_entry(image_id)
+            start, stop = index["instances"][i:i + 2]
+            boxes = index["boxes"][start:stop]
+            shapes = boxes[:, 2:] - boxes[:, :2]
+            offset = index["mask_offsets"][i]
+            size = sum((h * w + 7) // 8 for h, w in shapes)
+            masks = unpack_masks(data[offset:offset + size], shapes)
+            return boxes, masks, index["class_ids"][start:stop].copy()
+        start, stop = info["instances"]
+        boxes = self.instance_boxes(image_id)
+        class_ids = self.polygon_class_ids[start:stop].copy()
+        if self.mask_cache is not None:
+            key = MaskCache.key(info)
+            masks = self.mask_cache.get(key, boxes[:, 2:] - boxes[:, :2])
+            if masks is not None:
+                return boxes, masks, class_ids
+        masks = []
+        for p, (y1, x1, y2, x2) in zip(range(start, stop), boxes):
+            a, b = self.polygon_offsets[p], self.polygon_offsets[p + 1]
+            # Rasterize in box coordinates. Shifting by whole pixels gives the
+            # same pixels as rasterizing over the full image.
+            crop = np.zeros([y2 - y1, x2 - x1], dtype=bool)
+            if crop.size:
+                rr, cc = skimage.draw.polygon(
+                    self.polygon_y[a:b].astype(np.float64) - y1,
+                    self.polygon_x[a:b].astype(np.float64) - x1,
+                    shape=crop.shape)
+                crop[rr, cc] = True
+            masks.append(crop)
+        if self.mask_cache is not None:
+            self.mask_cache.put(key, masks)
+        return boxes, masks, class_ids
 
     def image_reference(self, image_id):
         """Return the path of the image."""
@@ -276,19 +1337,42 @@ class BirdsDataset(utils.Dataset):
         if info["source"] == "birds":
             return info["path"]
         else:
-            super(self.__class__, self).image_reference(image_id)
+            super().image_reference(image_id)
+
+
+def birds_dataset_class():
+    """Return the BirdsDataset class, creating it on first use."""
+    cls = globals().get("BirdsDataset")
+    if cls is None:
+        from mrcnn import utils
+        cls = type("BirdsDataset", (BirdsDatasetMixin, utils.Dataset),
+                   {"__module__": __name__,
+                    "__doc__": "The birds dataset. See BirdsDatasetMixin."})
+        globals()["BirdsDataset"] = cls
+    return cls
+
+
+def __getattr__(name):
+    # Module attribute hook (PEP 562), creates birds.BirdsDataset lazily
+    if name == "BirdsDataset":
+        return birds_dataset_class()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def train(model):
     """Train the model."""
+    BirdsDataset = birds_dataset_class()
     # Training dataset.
     dataset_train = BirdsDataset()
-    dataset_train.load_birds(args.dataset, "train")
+    dataset_train.load_birds(args.dataset, "train", workers=args.workers)
     dataset_train.prepare()
+    if args.mask_cache:
+        dataset_train.enable_mask_cache(args.mask_cache,
+                                        int(args.mask_cache_gb * 1024 ** 3))
 
     # Validation dataset
     dataset_val = BirdsDataset()
-    dataset_val.load_birds(args.dataset, "val")
+    dataset_val.load_birds(args.dataset, "val", workers=args.workers)
     dataset_val.prepare()
 
     # *** This training schedule is an example. Update to your needs ***
@@ -302,42 +1386,924 @@ def train(model):
                 layers='heads')
 
 
-def color_splash(image, mask):
+def color_splash(image, mask, out=None):
     """Apply color splash effect.
     image: RGB image [height, width, 3]
     mask: instance segmentation mask [height, width, instance count]
+    out: Optional uint8 array [height, width, 3] to write the result to.
+        Reusing one buffer for every frame of a video saves an allocation
+        per frame.
 
     Returns result image.
     """
-    # Make a grayscale copy of the image. The grayscale copy still
-    # has 3 RGB channels, though.
-    gray = skimage.color.gray2rgb(skimage.color.rgb2gray(image)) * 255
+    import skimage.color
+    if out is None:
+        out = np.empty(image.shape[:2] + (3,), dtype=np.uint8)
+    # Make a grayscale copy of the image and broadcast it to the 3 RGB
+    # channels of the output. The uint8 cast truncates the same way as
+    # astype(np.uint8) did on the float image.
+    gray = skimage.color.rgb2gray(image)
+    gray *= 255
+    np.copyto(out, gray[..., np.newaxis], casting="unsafe")
     # Copy color pixels from the original color image where mask is set
     if mask.shape[-1] > 0:
         # We're treating all instances as one, so collapse the mask into one layer
-        mask = (np.sum(mask, -1, keepdims=True) >= 1)
-        splash = np.where(mask, image, gray).astype(np.uint8)
+        mask = collapse_masks(mask)
+        np.copyto(out, image, where=mask[..., np.newaxis], casting="unsafe")
+    return out
+
+
+def collapse_masks(mask):
+    """OR the instances of a [height, width, instance count] mask into one
+    [height, width] bool mask. Combining one instance slice at a time is
+    much faster than reducing over the short last axis with np.any().
+    """
+    collapsed = mask[..., 0] != 0
+    for i in range(1, mask.shape[-1]):
+        np.logical_or(collapsed, mask[..., i], out=collapsed)
+    return collapsed
+
+
+############################################################
+#  Pipelines
+############################################################
+
+# Marks the end of the items of a pipeline stage
+_END = object()
+
+
+def prefetch(iterable, queue_size=4):
+    """Iterate over iterable in a background thread.
+
+    Up to queue_size items are produced ahead of the consumer. Exceptions
+    raised by the iterable are re-raised in the consumer.
+    """
+    items = queue.Queue(queue_size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(items, item, stop):
+                    return
+        except BaseException as e:
+            _put(items, _Failure(e), stop)
+        else:
+            _put(items, _END, stop)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class _Failure(object):
+    """Carries an exception from a background thread to the consumer."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(q, item, stop):
+    """Put item in a bounded queue, waiting until there's space or stop is
+    set. Returns False if it gave up because of stop.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class StageThread(object):
+    """Runs func on every item passed to put(), in order, in a background
+    thread. The queue in front of the thread is bounded, so put() blocks
+    when the stage falls behind, which applies backpressure to the
+    producer.
+
+    Call close() to wait for all items to be processed. Errors raised by
+    func are re-raised by the next put() or by close().
+    """
+
+    def __init__(self, func, queue_size=4):
+        self.func = func
+        self._queue = queue.Queue(queue_size)
+        self._stop = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            if item is _END:
+                return
+            try:
+                self.func(item)
+            except BaseException as e:
+                self._error = e
+                # Unblock producers waiting in put()
+                self._stop.set()
+                return
+
+    def put(self, item):
+        if not _put(self._queue, item, self._stop) or self._error:
+            self._raise()
+
+    def close(self):
+        """Process the remaining items and stop the thread."""
+        if not self._stop.is_set():
+            _put(self._queue, _END, self._stop)
+        self._thread.join()
+        self._raise()
+
+    def abort(self):
+        """Stop the thread without processing the remaining items."""
+        self._stop.set()
+        self._thread.join()
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error
+        if self._stop.is_set() and self._thread.is_alive():
+            raise RuntimeError("Pipeline stage was aborted")
+
+
+def read_video_frames(vcapture):
+    """Yield the frames of a cv2.VideoCapture as RGB images."""
+    while True:
+        with METRICS.stage("read"):
+            success, image = vcapture.read()
+        if not success:
+            return
+        # OpenCV returns images as BGR, convert to RGB
+        yield image[..., ::-1]
+
+
+def batched(iterable, batch_size):
+    """Yield lists of batch_size items from iterable. The last list may be
+    shorter.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def detect_batch(model, images, verbose=0):
+    """Run model.detect() on up to config.BATCH_SIZE images in one call.
+
+    The model only accepts full batches, so a partial batch is padded by
+    repeating its last image, and the results of the padding are dropped.
+    Returns one result dict per image.
+    """
+    batch_size = model.config.BATCH_SIZE
+    assert 0 < len(images) <= batch_size
+    padded = list(images) + [images[-1]] * (batch_size - len(images))
+    with METRICS.stage("detect"):
+        return model.detect(padded, verbose=verbose)[:len(images)]
+
+
+class KeyframeGate(object):
+    """Picks the frames of a static-camera video that need a full detection.
+
+    A frame is a keyframe if it differs enough from the last keyframe, or
+    if max_interval frames went by since the last keyframe. The difference
+    score is the mean absolute difference of subsampled pixels, from 0 to
+    255, which costs a tiny fraction of a detection.
+    """
+
+    def __init__(self, threshold, max_interval=30, stride=8):
+        self.threshold = threshold
+        self.max_interval = max_interval
+        self.stride = stride
+        self.keyframes = 0
+        self.skipped = 0
+        self._reference = None
+        self._since = 0
+
+    def score(self, image):
+        """Return the difference between image and the last keyframe."""
+        thumb = image[::self.stride, ::self.stride].astype(np.int16)
+        if self._reference is None or thumb.shape != self._reference.shape:
+            return float("inf")
+        return float(np.mean(np.abs(thumb - self._reference)))
+
+    def is_keyframe(self, image):
+        if (self._since >= self.max_interval or
+                self.score(image) > self.threshold):
+            self._reference = image[::self.stride, ::self.stride].astype(np.int16)
+            self._since = 1
+            self.keyframes += 1
+            return True
+        self._since += 1
+        self.skipped += 1
+        return False
+
+
+def splash_video(model, vcapture, vwriter, queue_size=4, keyframe_gate=None,
+                 detections=None):
+    """Apply the color splash effect to every frame of a video.
+
+    Runs as a pipeline so the stages overlap instead of adding up: frames
+    are decoded in one background thread, detected in the calling thread
+    (Keras models must be called from the thread that built them), then
+    splashed and encoded in two more background threads. The stages are
+    connected by queues of queue_size frames, which bounds memory use and
+    keeps the stages in lockstep. Frame order is preserved.
+
+    Frames are detected in batches of config.BATCH_SIZE, so set
+    IMAGES_PER_GPU in the inference config to amortize the per-call
+    overhead of the model over several frames.
+
+    vwriter: Video writer of the splash, or None to only write detections.
+    keyframe_gate: Optional KeyframeGate. Only keyframes are detected, and
+        the frames in between reuse the masks of the last keyframe, which
+        suits fixed cameras where most frames barely change.
+    detections: Optional DetectionWriter, which gets one record per frame
+        from another background thread.
+
+    Returns the number of frames processed.
+    """
+    def encode(splash):
+        # RGB -> BGR to save image to video
+        with METRICS.stage("write"):
+            vwriter.write(splash[..., ::-1])
+        METRICS.add_frames()
+
+    def splash_frame(item):
+        image, masks, out = item
+        with METRICS.stage("splash"):
+            splash = color_splash(image, masks, out=out)
+        encoder.put(splash)
+
+    record = None
+
+    def record_frame(item):
+        # Frames between keyframes share the record of their keyframe
+        nonlocal record
+        frame, keyframe, r = item
+        if keyframe:
+            with METRICS.stage("record"):
+                record = detection_record(r)
+        detections.write(dict(frame=frame, keyframe=keyframe, **record))
+        if vwriter is None:
+            METRICS.add_frames()
+
+    # Stages in pipeline order, so closing them in order drains each one
+    # before the ones it feeds
+    stages = []
+    if vwriter is not None:
+        splasher = StageThread(splash_frame, queue_size)
+        encoder = StageThread(encode, queue_size)
+        stages += [splasher, encoder]
+    if detections is not None:
+        recorder = StageThread(record_frame, queue_size)
+        stages.append(recorder)
+    # Output buffers are reused round robin. A buffer is written by the
+    # splash stage and read by the encoder, and at most queue_size + 2
+    # frames can be between those points.
+    buffers = []
+    count = 0
+    r = None
+    try:
+        frames = batched(read_video_frames(vcapture), model.config.BATCH_SIZE)
+        for images in prefetch(frames, queue_size):
+            if keyframe_gate is None:
+                keyframes = [True] * len(images)
+            else:
+                keyframes = [keyframe_gate.is_keyframe(image) for image in images]
+            # Detect objects
+            detect_images = [i for i, k in zip(images, keyframes) if k]
+            results = iter(detect_batch(model, detect_images) if detect_images else [])
+            for image, keyframe in zip(images, keyframes):
+                if keyframe:
+                    r = next(results)
+                if detections is not None:
+                    recorder.put((count, keyframe, r))
+                if vwriter is not None:
+                    if len(buffers) < queue_size + 2:
+                        buffers.append(np.empty(image.shape[:2] + (3,), dtype=np.uint8))
+                    splasher.put((image, r['masks'], buffers[count % len(buffers)]))
+                count += 1
+        for stage in stages:
+            stage.close()
+    finally:
+        for stage in stages:
+            stage.abort()
+    if keyframe_gate is not None:
+        print("Detected {} keyframes, skipped {} of {} frames".format(
+            keyframe_gate.keyframes, keyframe_gate.skipped, count))
+    return count
+
+
+############################################################
+#  Tiled detection
+############################################################
+
+def tile_windows(height, width, tile_size, overlap):
+    """Split an image into overlapping square tiles.
+    Tiles are tile_size pixels wide, or the image size if that's smaller,
+    and the last row and column of tiles are aligned to the image edges.
+
+    Returns: list of (y1, x1, y2, x2) windows.
+    """
+    assert 0 <= overlap < tile_size
+
+    def starts(size):
+        if size <= tile_size:
+            return [0]
+        step = tile_size - overlap
+        last = size - tile_size
+        return list(range(0, last, step)) + [last]
+
+    return [(y, x, min(y + tile_size, height), min(x + tile_size, width))
+            for y in starts(height) for x in starts(width)]
+
+
+def detect_tiled(model, image, tile_size=None, overlap=128, iou_threshold=0.5):
+    """Detect objects in a large image tile by tile.
+
+    The model resizes its input to config.IMAGE_MAX_DIM, which shrinks small
+    objects in high resolution images to a few pixels. Instead, the image
+    is split into overlapping tiles of that size, the tiles are detected
+    in batches, and the detections are mapped back to image coordinates.
+
+    Objects on a tile border show up in more than one tile, often cut off
+    in all but one. Detections touching a border between two tiles are
+    marked as truncated, and duplicates are merged greedily: whole
+    detections are kept before truncated ones, higher scores before lower,
+    and a detection is dropped if its box overlaps a kept one by more than
+    iou_threshold, or if it's truncated and mostly inside a kept one.
+    Objects larger than the overlap are cut off in every tile, so the
+    remaining truncated parts of the same class that meet across a tile
+    border are then joined, see join_truncated().
+
+    Masks are kept cropped to their bounding boxes, so memory grows with
+    the number and size of the detections, not with the image.
+
+    tile_size: Tile size in pixels. Defaults to config.IMAGE_MAX_DIM.
+    overlap: Pixels shared by neighboring tiles. Objects smaller than that
+        are whole in at least one tile.
+
+    Returns a dict like model.detect(), with "rois", "class_ids" and
+    "scores" in image coordinates, but with the masks as "mask_boxes"
+    [N, (y1, x1, y2, x2)] and "mask_crops", a list of N bool arrays in the
+    format of BirdsDataset.load_mask_cropped().
+    """
+    height, width = image.shape[:2]
+    tile_size = tile_size or model.config.IMAGE_MAX_DIM
+    windows = tile_windows(height, width, tile_size, overlap)
+    rois, class_ids, scores, cut, tile_ids, mask_boxes, mask_crops = [], [], [], [], [], [], []
+    for batch in batched(range(len(windows)), model.config.BATCH_SIZE):
+        tiles = [image[y1:y2, x1:x2] for y1, x1, y2, x2 in (windows[t] for t in batch)]
+        for t, r in zip(batch, detect_batch(model, tiles)):
+            y1, x1, y2, x2 = windows[t]
+            offset = np.array([y1, x1, y1, x1], dtype=np.int32)
+            boxes, crops = crop_masks(r['masks'])
+            # Tile sides that are inside the image, as opposed to on its edge
+            inner = np.array([y1 > 0, x1 > 0, y2 < height, x2 < width])
+            local = r['rois']
+            touches = np.stack([local[:, 0] <= 1, local[:, 1] <= 1,
+                                local[:, 2] >= y2 - y1 - 1,
+                                local[:, 3] >= x2 - x1 - 1], axis=1)
+            rois.append(local + offset)
+            class_ids.append(r['class_ids'])
+            scores.append(r['scores'])
+            cut.append((touches & inner).reshape(-1, 4))
+            tile_ids.append(np.full([len(local)], t, dtype=np.int64))
+            mask_boxes.append(boxes + offset)
+            mask_crops.extend(crops)
+    rois = np.concatenate(rois).astype(np.int32)
+    class_ids = np.concatenate(class_ids).astype(np.int32)
+    scores = np.concatenate(scores)
+    cut = np.concatenate(cut)
+    tile_ids = np.concatenate(tile_ids)
+    truncated = cut.any(axis=1)
+    mask_boxes = np.concatenate(mask_boxes).astype(np.int32)
+
+    # Merge duplicates, whole detections first, then by descending score
+    order = np.lexsort((-scores, truncated))
+    intersections = box_intersections(rois, rois)
+    areas = np.maximum((rois[:, 2] - rois[:, 0]) * (rois[:, 3] - rois[:, 1]), 1)
+    ious = intersections / np.maximum(areas[:, None] + areas[None, :] - intersections, 1)
+    keep = []
+    for i in order:
+        if keep:
+            if ious[i, keep].max() > iou_threshold:
+                continue
+            if truncated[i] and intersections[i, keep].max() / areas[i] > 0.7:
+                continue
+        keep.append(i)
+
+    # Join the parts of objects cut off in every tile
+    groups = join_truncated(keep, rois, class_ids, cut, tile_ids, windows,
+                            intersections)
+    out_rois, out_mask_boxes, out_mask_crops = [], [], []
+    for group in groups:
+        out_rois.append(np.concatenate([rois[group, :2].min(axis=0),
+                                        rois[group, 2:].max(axis=0)]))
+        if len(group) == 1:
+            out_mask_boxes.append(mask_boxes[group[0]])
+            out_mask_crops.append(mask_crops[group[0]])
+            continue
+        boxes = mask_boxes[group]
+        box = np.concatenate([boxes[:, :2].min(axis=0), boxes[:, 2:].max(axis=0)])
+        crop = np.zeros([box[2] - box[0], box[3] - box[1]], dtype=bool)
+        for (y1, x1, y2, x2), m in zip(boxes, (mask_crops[i] for i in group)):
+            view = crop[y1 - box[0]:y2 - box[0], x1 - box[1]:x2 - box[1]]
+            np.logical_or(view, m, out=view)
+        out_mask_boxes.append(box)
+        out_mask_crops.append(crop)
+    return {"rois": np.array(out_rois, dtype=np.int32).reshape(-1, 4),
+            "class_ids": class_ids[[g[0] for g in groups]].astype(np.int32),
+            "scores": np.array([scores[g].max() for g in groups], dtype=scores.dtype),
+            "mask_boxes": np.array(out_mask_boxes, dtype=np.int32).reshape(-1, 4),
+            "mask_crops": out_mask_crops}
+
+
+def join_truncated(keep, rois, class_ids, cut, tile_ids, windows, intersections):
+    """Group the parts of objects that are cut off in every tile they're in.
+
+    Two truncated detections are parts of one object if they have the same
+    class, come from different tiles, their boxes overlap, and one is cut
+    at the bottom (right) side of its tile while the other is cut at the
+    top (left) side of a tile that starts inside the first one. Parts are
+    grouped transitively, so an object over four tiles becomes one group.
+
+    keep: Indices of the detections to group.
+    cut: [N, (top, left, bottom, right)] bool, the interior tile sides
+        each detection touches.
+    tile_ids: Index into windows of the tile of each detection.
+    intersections: [N, N] box intersection areas.
+
+    Returns: A list of groups, each a list of detection indices, in the
+        order of keep.
+    """
+    parent = {i: i for i in keep}
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def meets(a, b):
+        # a is cut at its tile's bottom or right side, b at the top or left
+        # side of a tile that starts before a's tile ends
+        wa, wb = windows[tile_ids[a]], windows[tile_ids[b]]
+        return ((cut[a, 2] and cut[b, 0] and wa[0] < wb[0] < wa[2]) or
+                (cut[a, 3] and cut[b, 1] and wa[1] < wb[1] < wa[3]))
+
+    parts = [i for i in keep if cut[i].any()]
+    for n, a in enumerate(parts):
+        for b in parts[n + 1:]:
+            if (class_ids[a] == class_ids[b] and tile_ids[a] != tile_ids[b]
+                    and intersections[a, b] > 0 and (meets(a, b) or meets(b, a))):
+                parent[find(b)] = find(a)
+    groups = collections.OrderedDict()
+    for i in keep:
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def collapse_cropped_masks(boxes, masks, shape):
+    """Like collapse_masks(), for cropped masks.
+    boxes, masks: As returned by BirdsDataset.load_mask_cropped().
+    shape: (height, width) of the image.
+
+    Returns: [height, width, 1] bool mask, which color_splash() accepts.
+    """
+    collapsed = np.zeros(tuple(shape) + (1,), dtype=bool)
+    for (y1, x1, y2, x2), m in zip(boxes, masks):
+        np.logical_or(collapsed[y1:y2, x1:x2, 0], m, out=collapsed[y1:y2, x1:x2, 0])
+    return collapsed
+
+
+def detect_and_mask(model, image, tile_size=None, tile_overlap=128):
+    """Detect one image, tiled if tile_size is given.
+    Returns (result dict, mask for color_splash()).
+    """
+    if tile_size:
+        r = detect_tiled(model, image, tile_size, tile_overlap)
+        return r, collapse_cropped_masks(r['mask_boxes'], r['mask_crops'],
+                                         image.shape[:2])
+    r = detect_batch(model, [image])[0]
+    return r, r['masks']
+
+
+############################################################
+#  Detection output
+############################################################
+
+def class_name(class_id):
+    """Return the species name of a class ID."""
+    return BIRD_CLASSES[class_id - 1] if 0 < class_id <= len(BIRD_CLASSES) else "BG"
+
+
+def encode_rle(mask):
+    """Run-length encode a 2D mask in column-major order, like the
+    uncompressed RLE of COCO. Counts alternate between runs of 0s and 1s,
+    starting with 0s, so the first count is 0 if the first pixel is set.
+
+    Returns: list of run lengths.
+    """
+    flat = np.asarray(mask, dtype=bool).ravel(order="F")
+    if not flat.size:
+        return []
+    ends = np.append(np.flatnonzero(flat[1:] != flat[:-1]) + 1, flat.size)
+    counts = np.diff(ends, prepend=0)
+    if flat[0]:
+        counts = np.insert(counts, 0, 0)
+    return counts.tolist()
+
+
+def decode_rle(counts, shape):
+    """Decode a mask encoded by encode_rle().
+    shape: (height, width) of the mask.
+    """
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(shape, order="F")
+
+
+def detection_record(r):
+    """Convert a model.detect() or detect_tiled() result into a JSON
+    serializable dict, with species names next to the class IDs.
+
+    Each mask is cropped to its bounding box and stored as {"box": [y1,
+    x1, y2, x2], "counts": encode_rle(crop)}, which keeps records small
+    when birds cover a small part of the image.
+    """
+    if "mask_crops" in r:
+        boxes, crops = r['mask_boxes'], r['mask_crops']
+    else:
+        boxes, crops = crop_masks(r['masks'])
+    return {"rois": r['rois'].tolist(),
+            "class_ids": r['class_ids'].tolist(),
+            "classes": [class_name(c) for c in r['class_ids']],
+            "scores": [round(float(s), 4) for s in r['scores']],
+            "masks": [{"box": [int(v) for v in box], "counts": encode_rle(crop)}
+                      for box, crop in zip(boxes, crops)]}
+
+
+class DetectionWriter(object):
+    """Writes detection records to a file, one JSON object per line.
+    Paths ending in .gz are gzip compressed.
+
+    append: Add to an existing file rather than replacing it.
+    """
+
+    def __init__(self, path, append=False):
+        import gzip
+        self.path = path
+        mode = "at" if append else "wt"
+        if path.endswith(".gz"):
+            self._file = gzip.open(path, mode, encoding="utf-8")
+        else:
+            self._file = open(path, mode, encoding="utf-8")
+
+    def write(self, record):
+        with METRICS.stage("write_detections"):
+            self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+############################################################
+#  Bulk splash
+############################################################
+
+# File extensions picked up when splashing a directory of images
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
+
+def list_images(spec, exclude_dir=None):
+    """Expand an image source into a sorted list of paths.
+    spec: A directory (searched recursively), a text file with one path
+        per line, or a glob pattern.
+    exclude_dir: Directory left out of the recursive search, e.g. the
+        output directory when it's inside spec.
+    """
+    if os.path.isdir(spec):
+        exclude_dir = exclude_dir and os.path.realpath(exclude_dir)
+        paths = []
+        for root, dirs, files in os.walk(spec):
+            dirs[:] = [d for d in dirs
+                       if os.path.realpath(os.path.join(root, d)) != exclude_dir]
+            paths += [os.path.join(root, f) for f in files
+                      if f.lower().endswith(IMAGE_EXTENSIONS)]
+    elif os.path.isfile(spec) and spec.endswith(".txt"):
+        with open(spec) as f:
+            paths = [line.strip() for line in f if line.strip()]
     else:
-        splash = gray.astype(np.uint8)
-    return splash
+        paths = glob.glob(spec, recursive=True)
+    return sorted(paths)
+
+
+def splash_output_name(image_path):
+    """Return the output file name for an image.
+
+    Names are stable across runs, and a hash of the absolute path keeps
+    images with the same name in different directories apart.
+    """
+    image_path = os.path.abspath(image_path)
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    digest = hashlib.sha1(image_path.encode("utf-8")).hexdigest()[:10]
+    return "splash_{}_{}.png".format(stem, digest)
+
+
+def load_rgb_image(image_path):
+    """Read an image as RGB, the way utils.Dataset.load_image() does.
+    image_path: Path or file object of the image.
+    """
+    import skimage.color
+    import skimage.io
+    image = skimage.io.imread(image_path)
+    # If grayscale. Convert to RGB for consistency.
+    if image.ndim != 3:
+        image = skimage.color.gray2rgb(image)
+    # If has an alpha channel, remove it for consistency
+    if image.shape[-1] == 4:
+        image = image[..., :3]
+    return image
+
 
+def splash_files(model, image_paths, output_dir, tile_size=None, tile_overlap=128,
+                 splash=True, detections=False):
+    """Detect and color splash a batch of up to config.BATCH_SIZE images.
+    With tile_size, each image is detected on its own with detect_tiled().
+    splash: Write the color splash of each image to output_dir.
+    detections: Return a detection_record() of each image.
+
+    An image that can't be read, detected or written doesn't stop the
+    others; it's returned in the failures instead.
+
+    Returns (image paths, records, failures). Each record has the absolute
+    path of its image in "image". failures is a list of (image path, error
+    message) of the images that failed, which aren't in image paths.
+    """
+    import skimage.io
+    failures = []
+
+    def failed(path, e):
+        # Keep the error on one line, the log has one line per image
+        message = " ".join(str(e).split())
+        failures.append((path, "{}: {}".format(type(e).__name__, message)
+                         if message else type(e).__name__))
+
+    paths, images = [], []
+    with METRICS.stage("read"):
+        for p in image_paths:
+            try:
+                images.append(load_rgb_image(p))
+                paths.append(p)
+            except Exception as e:
+                failed(p, e)
+    detected = []
+    if tile_size:
+        for path, image in zip(paths, images):
+            try:
+                r, mask = detect_and_mask(model, image, tile_size, tile_overlap)
+            except Exception as e:
+                failed(path, e)
+                continue
+            detected.append((path, image, r, mask))
+    elif images:
+        try:
+            results = detect_batch(model, images)
+        except Exception as e:
+            # The batch is detected at once, so all of its images fail
+            for path in paths:
+                failed(path, e)
+        else:
+            detected = [(path, image, r, r['masks'])
+                        for path, image, r in zip(paths, images, results)]
+    done, records = [], []
+    for path, image, r, mask in detected:
+        try:
+            record = None
+            if detections:
+                with METRICS.stage("record"):
+                    record = dict(image=os.path.abspath(path), **detection_record(r))
+            if splash:
+                output_path = os.path.join(output_dir, splash_output_name(path))
+                with METRICS.stage("splash"):
+                    splash_image = color_splash(image, mask)
+                # Write to a temporary name first, so an interrupted run never
+                # leaves a truncated file under the final name.
+                tmp_path = output_path + ".tmp.png"
+                with METRICS.stage("write"):
+                    skimage.io.imsave(tmp_path, splash_image)
+                    os.replace(tmp_path, output_path)
+        except Exception as e:
+            failed(path, e)
+            continue
+        done.append(path)
+        if record is not None:
+            records.append(record)
+        METRICS.add_frames()
+    return done, records, failures
+
+
+# Model of a bulk splash worker process, see _init_splash_worker()
+_worker_model = None
+
+
+def _init_splash_worker(config, weights_path, logs_dir):
+    """Build the model once per worker process."""
+    from mrcnn import model as modellib
+    global _worker_model
+    _worker_model = modellib.MaskRCNN(mode="inference", config=config,
+                                      model_dir=logs_dir)
+    _worker_model.load_weights(weights_path, by_name=True)
+
+
+def _splash_files_in_worker(image_paths, **kwargs):
+    return splash_files(_worker_model, image_paths, **kwargs)
+
+
+def find_last_weights(config, logs_dir):
+    """Finds the last checkpoint like MaskRCNN.find_last(), but without
+    building a model.
+
+    Returns: The path of the last checkpoint file in the newest
+        training directory of config.NAME under logs_dir.
+    """
+    key = config.NAME.lower()
+    dir_names = sorted(d for d in next(os.walk(logs_dir))[1] if d.startswith(key))
+    if not dir_names:
+        raise FileNotFoundError(
+            "Could not find model directory under {}".format(logs_dir))
+    dir_name = os.path.join(logs_dir, dir_names[-1])
+    checkpoints = sorted(f for f in next(os.walk(dir_name))[2]
+                         if f.startswith("mask_rcnn"))
+    if not checkpoints:
+        raise FileNotFoundError(
+            "Could not find weight files in {}".format(dir_name))
+    return os.path.join(dir_name, checkpoints[-1])
+
+
+def splash_images(model, image_paths, output_dir, manifest_path=None,
+                  workers=0, weights_path=None, logs_dir=DEFAULT_LOGS_DIR,
+                  tile_size=None, tile_overlap=128, splash=True, detections_path=None,
+                  config=None):
+    """Color splash a large set of images, resumably.
+
+    Every finished image is appended to a manifest file, and images
+    already in the manifest are skipped, so an interrupted run continues
+    where it stopped. Outputs are named by splash_output_name().
+
+    model: Model used when workers <= 1. Can be None with workers, as
+        long as config is given.
+    workers: Number of worker processes. Each loads its own copy of the
+        model from weights_path, with the same config as model.
+    config: Inference config of the workers. Defaults to model.config.
+    tile_size, tile_overlap: Detect images in tiles, see detect_tiled().
+    splash: Write color splash images. Can be turned off when only the
+        detections are needed.
+    detections_path: Append a record per image to this JSONL file, see
+        DetectionWriter. Records are written before the image is added to
+        the manifest, so a resumed run may repeat a few records, but never
+        misses one.
+
+    Images that fail are logged with their error to a "_failed.txt" file
+    next to the manifest and left out of the manifest, so the next run
+    tries them again.
+
+    Returns the number of images processed by this run.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if manifest_path is None:
+        manifest_path = os.path.join(output_dir, "splash_manifest.txt")
+    failed_path = os.path.splitext(manifest_path)[0] + "_failed.txt"
+    done = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            done = set(line.rstrip("\n") for line in f)
+    pending = [p for p in image_paths if os.path.abspath(p) not in done]
+    print("Splashing {} images, {} already done".format(
+        len(pending), len(image_paths) - len(pending)))
+
+    if config is None:
+        config = model.config
+    batches = batched(pending, config.BATCH_SIZE)
+    options = dict(output_dir=output_dir, tile_size=tile_size,
+                   tile_overlap=tile_overlap, splash=splash,
+                   detections=detections_path is not None)
+    count = failed = 0
+    with contextlib.ExitStack() as stack:
+        manifest = stack.enter_context(open(manifest_path, "a"))
+        writer = None
+        if detections_path is not None:
+            writer = stack.enter_context(DetectionWriter(detections_path, append=True))
+        if workers and workers > 1:
+            # Spawn rather than fork, since forking a process that already
+            # initialized TensorFlow isn't safe.
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(workers, initializer=_init_splash_worker,
+                              initargs=(config, weights_path, logs_dir)) as pool:
+                finished = pool.imap_unordered(
+                    functools.partial(_splash_files_in_worker, **options), batches)
+                for paths, records, failures in finished:
+                    count += _record_done(manifest, paths, records, writer)
+                    failed += _record_failed(failed_path, failures)
+        else:
+            for paths in batches:
+                paths, records, failures = splash_files(model, paths, **options)
+                count += _record_done(manifest, paths, records, writer)
+                failed += _record_failed(failed_path, failures)
+    if failed:
+        print("{} images failed, see {}".format(failed, failed_path))
+    return count
+
+
+def _record_done(manifest, paths, records, writer):
+    """Write the detections of finished images and append the images to
+    the manifest. Returns their count.
+    """
+    if writer is not None:
+        for record in records:
+            writer.write(record)
+        writer.flush()
+    for p in paths:
+        manifest.write(os.path.abspath(p) + "\n")
+    manifest.flush()
+    return len(paths)
+
+
+def _record_failed(failed_path, failures):
+    """Log the failed images with their errors. Returns their count.
+    The log file is only created once an image fails.
+    """
+    if failures:
+        with open(failed_path, "a") as log:
+            for path, error in failures:
+                print("Failed {}: {}".format(path, error))
+                log.write("{}\t{}\n".format(os.path.abspath(path), error))
+    return len(failures)
 
-def detect_and_color_splash(model, image_path=None, video_path=None):
+
+def detect_and_color_splash(model, image_path=None, video_path=None,
+                            queue_size=4, keyframe_threshold=None,
+                            keyframe_interval=30, tile_size=None, tile_overlap=128,
+                            splash=True, detections_path=None):
     assert image_path or video_path
+    assert splash or detections_path
+    detections = DetectionWriter(detections_path) if detections_path else None
 
     # Image or video?
     if image_path:
+        import skimage.io
         # Run model detection and generate the color splash effect
-        print("Running on {}".format(args.image))
+        print("Running on {}".format(image_path))
         # Read image
-        image = skimage.io.imread(args.image)
+        image = skimage.io.imread(image_path)
         # Detect objects
-        r = model.detect([image], verbose=1)[0]
-        # Color splash
-        splash = color_splash(image, r['masks'])
-        # Save output
-        file_name = "splash_{:%Y%m%dT%H%M%S}.png".format(datetime.datetime.now())
-        skimage.io.imsave(file_name, splash)
+        if tile_size:
+            r, mask = detect_and_mask(model, image, tile_size, tile_overlap)
+        else:
+            r = detect_batch(model, [image], verbose=1)[0]
+            mask = r['masks']
+        if detections is not None:
+            detections.write(dict(image=os.path.abspath(image_path),
+                                  **detection_record(r)))
+            detections.close()
+        if splash:
+            # Color splash
+            splash_image = color_splash(image, mask)
+            # Save output
+            file_name = "splash_{:%Y%m%dT%H%M%S}.png".format(datetime.datetime.now())
+            skimage.io.imsave(file_name, splash_image)
     elif video_path:
         import cv2
         # Video capture
@@ -347,31 +2313,664 @@ def detect_and_color_splash(model, image_path=None, video_path=None):
         fps = vcapture.get(cv2.CAP_PROP_FPS)
 
         # Define codec and create video writer
-        file_name = "splash_{:%Y%m%dT%H%M%S}.avi".format(datetime.datetime.now())
-        vwriter = cv2.VideoWriter(file_name,
-                                  cv2.VideoWriter_fourcc(*'MJPG'),
-                                  fps, (width, height))
-
-        count = 0
-        success = True
-        while success:
-            print("frame: ", count)
-            # Read next image
-            success, image = vcapture.read()
-            if success:
-                # OpenCV returns images as BGR, convert to RGB
-                image = image[..., ::-1]
-                # Detect objects
-                r = model.detect([image], verbose=0)[0]
-                # Color splash
-                splash = color_splash(image, r['masks'])
-                # RGB -> BGR to save image to video
-                splash = splash[..., ::-1]
-                # Add image to video writer
-                vwriter.write(splash)
-                count += 1
-        vwriter.release()
-    print("Saved to ", file_name)
+        vwriter = None
+        if splash:
+            file_name = "splash_{:%Y%m%dT%H%M%S}.avi".format(datetime.datetime.now())
+            vwriter = cv2.VideoWriter(file_name,
+                                      cv2.VideoWriter_fourcc(*'MJPG'),
+                                      fps, (width, height))
+        try:
+            gate = None
+            if keyframe_threshold is not None:
+                gate = KeyframeGate(keyframe_threshold, keyframe_interval)
+            splash_video(model, vcapture, vwriter, queue_size=queue_size,
+                         keyframe_gate=gate, detections=detections)
+        finally:
+            if vwriter is not None:
+                vwriter.release()
+            vcapture.release()
+            if detections is not None:
+                detections.close()
+    if splash:
+        print("Saved to ", file_name)
+    if detections is not None:
+        print("Saved detections to ", detections_path)
+
+
+############################################################
+#  Inference server
+############################################################
+
+class ServerOverloaded(Exception):
+    """Raised when the request queue of a MicroBatcher is full."""
+
+
+class MicroBatcher(object):
+    """Groups concurrent detection requests into batched model.detect() calls.
+
+    Requests are queued by submit(), from any thread. run() takes the first
+    waiting request, waits up to max_wait seconds for more to arrive, and
+    runs the batch through the model. A batch holds at most
+    config.BATCH_SIZE images. The queue is bounded, so under overload new
+    requests are rejected right away instead of waiting behind a growing
+    backlog, which keeps tail latency bounded.
+    """
+
+    def __init__(self, model, max_wait=0.01, max_queue=64):
+        self.model = model
+        self.max_wait = max_wait
+        self.max_batch = model.config.BATCH_SIZE
+        self._queue = queue.Queue(max_queue)
+        self._stop = threading.Event()
+
+    def submit(self, image):
+        """Queue an image for detection.
+        Returns a concurrent.futures.Future of its result dict.
+        """
+        future = concurrent.futures.Future()
+        try:
+            self._queue.put_nowait((image, future))
+        except queue.Full:
+            raise ServerOverloaded()
+        return future
+
+    def run(self):
+        """Process requests until stop() is called. Runs the model in the
+        calling thread, which must be the thread that built it.
+        """
+        while not self._stop.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Skip requests whose clients already gave up
+            batch = [(i, f) for i, f in batch if f.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = detect_batch(self.model, [image for image, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), r in zip(batch, results):
+                future.set_result(r)
+
+    def stop(self):
+        self._stop.set()
+
+
+class _DetectionHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP interface of the inference server.
+
+    POST /detect with an encoded image returns the detections as JSON.
+    POST /splash returns the color splash as PNG.
+    GET /health returns 200 once the server is up.
+    """
+    protocol_version = "HTTP/1.1"
+    batcher = None
+    timeout_seconds = 30
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, "application/json", b'{"status": "ok"}')
+        else:
+            self._reply(404, "text/plain", b"Not found")
+
+    def do_POST(self):
+        import cv2
+        length = self.headers.get("Content-Length")
+        if length is None or not length.strip().isdigit():
+            # The end of the body is unknown, so the connection can't be
+            # reused
+            self.close_connection = True
+            if length is None:
+                self._reply(411, "text/plain", b"Content-Length required")
+            else:
+                self._reply(400, "text/plain", b"Invalid Content-Length")
+            return
+        # Read the body before any reply, so the next request on a
+        # keep-alive connection doesn't start in the middle of it
+        length = int(length)
+        data = np.frombuffer(self.rfile.read(length), dtype=np.uint8)
+        if self.path not in ("/detect", "/splash"):
+            self._reply(404, "text/plain", b"Not found")
+            return
+        image = cv2.imdecode(data, cv2.IMREAD_COLOR) if length else None
+        if image is None:
+            self._reply(400, "text/plain", b"Could not decode image")
+            return
+        # OpenCV decodes to BGR, convert to RGB
+        image = np.ascontiguousarray(image[..., ::-1])
+        try:
+            future = self.batcher.submit(image)
+            r = future.result(timeout=self.timeout_seconds)
+        except ServerOverloaded:
+            self._reply(503, "text/plain", b"Server overloaded")
+            return
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self._reply(504, "text/plain", b"Detection timed out")
+            return
+        except Exception as e:
+            self._reply(500, "text/plain", str(e).encode("utf-8"))
+            return
+        if self.path == "/detect":
+            body = json.dumps(detection_record(r)).encode("utf-8")
+            self._reply(200, "application/json", body)
+        else:
+            splash = color_splash(image, r['masks'])
+            _, png = cv2.imencode(".png", splash[..., ::-1])
+            self._reply(200, "image/png", png.tobytes())
+
+    def _reply(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        # Per request logging costs more than the requests themselves
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def serve(model, host="127.0.0.1", port=8000, socket_path=None,
+          max_wait=0.01, max_queue=64, timeout=30):
+    """Serve detections over HTTP until interrupted.
+
+    The model is loaded once and shared by all requests. Requests that
+    arrive within max_wait seconds of each other are detected in one batch
+    of up to config.BATCH_SIZE images.
+
+    socket_path: If given, listen on this Unix socket instead of host:port.
+    max_queue: Requests waiting beyond this are rejected with 503.
+    timeout: Seconds a request waits for its result before a 504.
+    """
+    batcher = MicroBatcher(model, max_wait=max_wait, max_queue=max_queue)
+    handler = type("DetectionHandler", (_DetectionHandler,),
+                   {"batcher": batcher, "timeout_seconds": timeout})
+    if socket_path:
+        try:
+            mode = os.stat(socket_path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            # Only replace a stale socket, never another file
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(
+                    "{} exists and isn't a socket".format(socket_path))
+            os.remove(socket_path)
+        server = _UnixHTTPServer(socket_path, handler)
+        address = socket_path
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        address = "http://{}:{}".format(*server.server_address[:2])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print("Serving on {} (batch size {}, window {} ms)".format(
+        address, batcher.max_batch, max_wait * 1000))
+    try:
+        batcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batcher.stop()
+        server.shutdown()
+        server.server_close()
+
+
+############################################################
+#  Evaluation
+############################################################
+
+def box_intersections(boxes1, boxes2):
+    """Compute the intersection areas of two sets of boxes.
+    boxes1, boxes2: [N, (y1, x1, y2, x2)] and [M, (y1, x1, y2, x2)].
+
+    Returns: [N, M] float array.
+    """
+    boxes1 = boxes1.astype(np.float64)
+    boxes2 = boxes2.astype(np.float64)
+    y1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    x1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    y2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    x2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    return np.maximum(y2 - y1, 0) * np.maximum(x2 - x1, 0)
+
+
+def compute_box_overlaps(boxes1, boxes2):
+    """Compute the IoU matrix of two sets of boxes in one vectorized step.
+    boxes1, boxes2: [N, (y1, x1, y2, x2)] and [M, (y1, x1, y2, x2)].
+
+    Returns: [N, M] array of IoUs.
+    """
+    intersection = box_intersections(boxes1, boxes2)
+    boxes1 = boxes1.astype(np.float64)
+    boxes2 = boxes2.astype(np.float64)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = area1[:, None] + area2[None, :] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+
+def compute_mask_overlaps(masks1, masks2):
+    """Compute the IoU matrix of two sets of masks.
+    masks1, masks2: [height, width, N] and [height, width, M].
+
+    Intersections are one matrix product, restricted to the pixels covered
+    by any mask of masks2 since no other pixel can intersect. That keeps
+    the temporary arrays small when masks2 holds a few ground truth
+    objects and masks1 up to a hundred detections.
+
+    Returns: [N, M] array of IoUs.
+    """
+    n, m = masks1.shape[-1], masks2.shape[-1]
+    if n == 0 or m == 0:
+        return np.zeros((n, m))
+    flat1 = masks1.reshape(-1, n)
+    flat2 = masks2.reshape(-1, m)
+    pixels = np.flatnonzero(collapse_masks(masks2))
+    intersection = np.dot((flat1[pixels] != 0).T.astype(np.float32),
+                          (flat2[pixels] != 0).astype(np.float32))
+    area1 = np.count_nonzero(flat1, axis=0)
+    area2 = np.count_nonzero(flat2, axis=0)
+    union = area1[:, None] + area2[None, :] - intersection
+    return intersection / np.maximum(union, 1)
+
+
+class APAccumulator(object):
+    """Accumulates detections image by image and computes the average
+    precision of each class.
+
+    Only the score and the true/false positive flag of each detection is
+    kept, so memory doesn't grow with the size of images or masks.
+    """
+
+    def __init__(self, num_classes, iou_threshold=0.5):
+        self.num_classes = num_classes
+        self.iou_threshold = iou_threshold
+        self.gt_counts = np.zeros([num_classes], dtype=np.int64)
+        self._scores = [[] for _ in range(num_classes)]
+        self._matches = [[] for _ in range(num_classes)]
+
+    def add(self, gt_class_ids, pred_class_ids, pred_scores, overlaps):
+        """Add the detections of one image.
+        overlaps: [pred count, gt count] IoU matrix.
+        """
+        for c in np.union1d(gt_class_ids, pred_class_ids):
+            gt_ix = np.flatnonzero(gt_class_ids == c)
+            pred_ix = np.flatnonzero(pred_class_ids == c)
+            pred_ix = pred_ix[np.argsort(-pred_scores[pred_ix], kind="stable")]
+            self.gt_counts[c] += len(gt_ix)
+            # Greedily match detections in score order to the unmatched
+            # ground truth object with the highest IoU.
+            class_overlaps = overlaps[np.ix_(pred_ix, gt_ix)]
+            matched = np.zeros([len(gt_ix)], dtype=bool)
+            matches = np.zeros([len(pred_ix)], dtype=bool)
+            for i, row in enumerate(class_overlaps):
+                row = np.where(matched, -1, row)
+                if len(row) and row.max() >= self.iou_threshold:
+                    matched[row.argmax()] = True
+                    matches[i] = True
+            self._scores[c].append(pred_scores[pred_ix])
+            self._matches[c].append(matches)
+
+    def compute(self):
+        """Return the AP of each class, NaN for classes without ground truth."""
+        aps = np.full([self.num_classes], np.nan)
+        for c in range(self.num_classes):
+            if self.gt_counts[c] == 0:
+                continue
+            if not self._scores[c]:
+                aps[c] = 0
+                continue
+            scores = np.concatenate(self._scores[c])
+            matches = np.concatenate(self._matches[c])[np.argsort(-scores, kind="stable")]
+            # Precision and recall at each detection, like utils.compute_ap()
+            true_positives = np.cumsum(matches)
+            precisions = true_positives / np.arange(1, len(matches) + 1)
+            recalls = true_positives / self.gt_counts[c]
+            precisions = np.concatenate([[0], precisions, [0]])
+            recalls = np.concatenate([[0], recalls, [1]])
+            # Make precision monotonically decreasing, then sum the
+            # precision at each recall step.
+            precisions = np.maximum.accumulate(precisions[::-1])[::-1]
+            steps = np.flatnonzero(recalls[1:] != recalls[:-1]) + 1
+            aps[c] = np.sum((recalls[steps] - recalls[steps - 1]) * precisions[steps])
+        return aps
+
+
+def map_threads(func, items, workers, window=None):
+    """Like map(), but runs func in a thread pool. At most window calls are
+    in flight, which bounds memory, and results come back in order.
+    """
+    window = window or 2 * workers
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def evaluate_birds(model, dataset, limit=0, iou_threshold=0.5, workers=0):
+    """Compute box and mask AP for each class of a dataset.
+
+    Images are detected in batches of config.BATCH_SIZE. With workers > 0,
+    images and ground truth masks are loaded by a thread pool while the
+    model runs. Results are accumulated image by image, so memory use
+    doesn't depend on the number of images.
+
+    limit: if not 0, the number of images to use for evaluation.
+    Returns a dict with the per-class "bbox" and "mask" AP arrays and their
+    means over the classes that have ground truth.
+    """
+    from mrcnn import utils
+    image_ids = dataset.image_ids
+    if limit:
+        image_ids = image_ids[:limit]
+
+    def load(image_id):
+        mask, class_ids = dataset.load_mask(image_id)
+        return dataset.load_image(image_id), mask, class_ids
+
+    if workers and workers > 0:
+        samples = map_threads(load, image_ids, workers)
+    else:
+        samples = map(load, image_ids)
+
+    box_ap = APAccumulator(dataset.num_classes, iou_threshold)
+    mask_ap = APAccumulator(dataset.num_classes, iou_threshold)
+    t_prediction = 0
+    t_start = time.time()
+    for batch in batched(samples, model.config.BATCH_SIZE):
+        t = time.time()
+        results = detect_batch(model, [image for image, _, _ in batch])
+        t_prediction += (time.time() - t)
+        for (image, gt_mask, gt_class_ids), r in zip(batch, results):
+            gt_boxes = utils.extract_bboxes(gt_mask)
+            box_ap.add(gt_class_ids, r['class_ids'], r['scores'],
+                       compute_box_overlaps(r['rois'], gt_boxes))
+            mask_ap.add(gt_class_ids, r['class_ids'], r['scores'],
+                        compute_mask_overlaps(r['masks'], gt_mask))
+
+    box_aps = box_ap.compute()
+    mask_aps = mask_ap.compute()
+    print("{:40} {:>6} {:>8} {:>8}".format("Class", "GT", "Box AP", "Mask AP"))
+    for c in range(1, dataset.num_classes):
+        if box_ap.gt_counts[c]:
+            print("{:40} {:6d} {:8.3f} {:8.3f}".format(
+                dataset.class_names[c], box_ap.gt_counts[c], box_aps[c], mask_aps[c]))
+    results = {"bbox": box_aps, "mask": mask_aps,
+               "bbox_map": np.nanmean(box_aps[1:]) if box_ap.gt_counts[1:].any() else 0.0,
+               "mask_map": np.nanmean(mask_aps[1:]) if mask_ap.gt_counts[1:].any() else 0.0}
+    print("mAP @ IoU {}: box {:.3f}, mask {:.3f}".format(
+        iou_threshold, results["bbox_map"], results["mask_map"]))
+    print("Prediction time: {}. Average {}/image".format(
+        t_prediction, t_prediction / max(len(image_ids), 1)))
+    print("Total time: ", time.time() - t_start)
+    return results
+
+
+############################################################
+#  Training inputs
+############################################################
+
+# Per process state of a training input worker, see _init_train_worker()
+_train_worker = None
+
+
+def _init_train_worker(dataset, config, augmentation, no_augmentation_sources,
+                       metrics_path=None, metrics_interval=10.0):
+    """Set up a training input worker process."""
+    global _train_worker
+    # Workers only run NumPy code, keep TensorFlow off the GPUs
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    from mrcnn import model as modellib, utils
+    if metrics_path:
+        root, ext = os.path.splitext(metrics_path)
+        if ext == ".prom":
+            metrics_path = "{}.{}.prom".format(root, os.getpid())
+        enable_metrics(metrics_path, metrics_interval)
+    backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
+    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                             config.RPN_ANCHOR_RATIOS,
+                                             backbone_shapes,
+                                             config.BACKBONE_STRIDES,
+                                             config.RPN_ANCHOR_STRIDE)
+    _train_worker = {"dataset": dataset, "config": config, "anchors": anchors,
+                     "augmentation": augmentation,
+                     "no_augmentation_sources": no_augmentation_sources or []}
+
+
+def _reseed(augmentation, seed):
+    """Reseed an imgaug augmenter, across imgaug versions."""
+    if hasattr(augmentation, "seed_"):
+        augmentation.seed_(seed)
+    else:
+        augmentation.reseed(seed)
+
+
+def _load_train_samples(samples):
+    """Load, augment and build the RPN targets of a list of
+    (image ID, seed) samples, the way modellib.data_generator() does.
+    Images without instances are skipped.
+
+    Returns a list of (image, image_meta, rpn_match, rpn_bbox,
+    gt_class_ids, gt_boxes, gt_masks) tuples. Images are returned as uint8
+    and molded by the caller, which keeps them 4x smaller in transit.
+    """
+    from mrcnn import model as modellib
+    w = _train_worker
+    dataset, config = w["dataset"], w["config"]
+    results = []
+    for image_id, seed in samples:
+        # Seed everything random per sample, so the result doesn't depend
+        # on which worker loads it or what it loaded before.
+        np.random.seed(seed)
+        augmentation = w["augmentation"]
+        if dataset.image_info[image_id]["source"] in w["no_augmentation_sources"]:
+            augmentation = None
+        if augmentation is not None:
+            _reseed(augmentation, seed)
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks = modellib.load_image_gt(
+            dataset, config, image_id, augmentation=augmentation,
+            use_mini_mask=config.USE_MINI_MASK)
+        if not np.any(gt_class_ids > 0):
+            continue
+        rpn_match, rpn_bbox = modellib.build_rpn_targets(
+            image.shape, w["anchors"], gt_class_ids, gt_boxes, config)
+        # If more instances than fit in the array, sub-sample from them.
+        if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+            ids = np.random.choice(np.arange(gt_boxes.shape[0]),
+                                   config.MAX_GT_INSTANCES, replace=False)
+            gt_class_ids = gt_class_ids[ids]
+            gt_boxes = gt_boxes[ids]
+            gt_masks = gt_masks[:, :, ids]
+        results.append((image, image_meta, rpn_match, rpn_bbox,
+                        gt_class_ids, gt_boxes, gt_masks))
+    return results
+
+
+def _train_batch(samples, config):
+    """Stack samples from _load_train_samples() into the inputs of the
+    Mask R-CNN training model.
+    """
+    from mrcnn import model as modellib
+    batch_size = len(samples)
+    images, image_meta, rpn_match, rpn_bbox, _, _, masks = zip(*samples)
+    batch_images = np.zeros((batch_size,) + images[0].shape, dtype=np.float32)
+    for i, image in enumerate(images):
+        batch_images[i] = modellib.mold_image(image.astype(np.float32), config)
+    batch_gt_class_ids = np.zeros((batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
+    batch_gt_boxes = np.zeros((batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
+    batch_gt_masks = np.zeros((batch_size,) + masks[0].shape[:2] +
+                              (config.MAX_GT_INSTANCES,), dtype=masks[0].dtype)
+    for i, (_, _, _, _, gt_class_ids, gt_boxes, gt_masks) in enumerate(samples):
+        n = gt_class_ids.shape[0]
+        batch_gt_class_ids[i, :n] = gt_class_ids
+        batch_gt_boxes[i, :n] = gt_boxes
+        batch_gt_masks[i, :, :, :n] = gt_masks
+    inputs = [batch_images, np.stack(image_meta),
+              np.stack(rpn_match)[:, :, np.newaxis], np.stack(rpn_bbox),
+              batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
+    return inputs, []
+
+
+def parallel_data_generator(dataset, config, shuffle=True, augmentation=None,
+                            batch_size=1, no_augmentation_sources=None,
+                            workers=4, prefetch=8, seed=None):
+    """Drop-in replacement for modellib.data_generator() that loads,
+    augments and builds targets in a pool of worker processes.
+
+    Each task is one batch worth of samples, and up to prefetch tasks are
+    in flight, so the model doesn't wait between batches as long as the
+    workers keep up. Results are consumed in submission order.
+
+    The order of images and a seed per sample are drawn from one random
+    state seeded with seed, and each worker reseeds NumPy and the
+    augmenter with the sample seed before loading it. So with a fixed seed
+    the batches are the same for any number of workers.
+    """
+    rng = np.random.RandomState(seed)
+    metrics_args = ()
+    if METRICS.enabled:
+        metrics_args = (METRICS.path, METRICS.interval)
+
+    def tasks():
+        image_ids = np.copy(dataset.image_ids)
+        while True:
+            if shuffle:
+                rng.shuffle(image_ids)
+            seeds = rng.randint(0, 2 ** 31 - 1, size=len(image_ids))
+            for chunk in batched(zip(image_ids.tolist(), seeds.tolist()), batch_size):
+                yield chunk
+
+    # Spawn rather than fork, since forking a process that already
+    # initialized TensorFlow isn't safe.
+    context = multiprocessing.get_context("spawn")
+    pool = context.Pool(workers, initializer=_init_train_worker,
+                        initargs=(dataset, config, augmentation,
+                                  no_augmentation_sources) + metrics_args)
+    try:
+        pending = collections.deque()
+        task_iter = tasks()
+        batch = []
+        while True:
+            while len(pending) < prefetch:
+                pending.append(pool.apply_async(_load_train_samples,
+                                                (next(task_iter),)))
+            with METRICS.stage("wait_inputs"):
+                samples = pending.popleft().get()
+            for sample in samples:
+                batch.append(sample)
+                if len(batch) == batch_size:
+                    yield _train_batch(batch, config)
+                    batch = []
+    finally:
+        pool.terminate()
+
+
+@contextlib.contextmanager
+def parallel_training_inputs(model, workers=4, prefetch=8, seed=None):
+    """Context manager that makes model.train() use
+    parallel_data_generator() for its training and validation inputs.
+
+    Mask R-CNN passes its generators to Keras with one process per CPU,
+    and every process runs its own copy of the generator. That wastes the
+    CPUs on duplicate batches and makes the order depend on scheduling, so
+    Keras is limited to one thread here, which only moves finished batches.
+    Its queue is cut from 100 batches to prefetch, since the pool already
+    reads ahead and a deep queue only holds more batches in memory.
+
+    Each generator gets its own seed derived from seed, so the train and
+    validation inputs of every stage are reproducible. The generators of
+    a stage, and their worker pools, are closed when it finishes.
+
+    Keras only reads validation batches at the end of each epoch, so the
+    validation generator gets a pool of workers // 8 processes, and the
+    training pool keeps the CPUs the rest of the time.
+    """
+    from mrcnn import model as modellib
+    original_generator = modellib.data_generator
+    # Generators of the current stage, and the number created so far
+    generators = []
+    created = 0
+
+    def close_generators():
+        # Stop the worker pools
+        for generator in generators:
+            generator.close()
+        del generators[:]
+
+    def data_generator(dataset, config, shuffle=True, augment=False,
+                       augmentation=None, random_rois=0, batch_size=1,
+                       detection_targets=False, no_augmentation_sources=None):
+        if augment or random_rois or detection_targets:
+            # Options only used for debugging, leave them to the original
+            return original_generator(
+                dataset, config, shuffle=shuffle, augment=augment,
+                augmentation=augmentation, random_rois=random_rois,
+                batch_size=batch_size, detection_targets=detection_targets,
+                no_augmentation_sources=no_augmentation_sources)
+        nonlocal created
+        generator_seed = None if seed is None else (seed, created)
+        created += 1
+        # model.train() creates the training generator of a stage first,
+        # then the validation one
+        generator_workers = max(1, workers // 8) if generators else workers
+        generator = parallel_data_generator(
+            dataset, config, shuffle=shuffle, augmentation=augmentation,
+            batch_size=batch_size,
+            no_augmentation_sources=no_augmentation_sources,
+            workers=generator_workers, prefetch=prefetch, seed=generator_seed)
+        generators.append(generator)
+        return generator
+
+    keras_model = model.keras_model
+    fit_generator = keras_model.fit_generator
+
+    def single_threaded_fit_generator(*args, **kwargs):
+        kwargs.update(workers=1, use_multiprocessing=False,
+                      max_queue_size=max(1, prefetch))
+        try:
+            return fit_generator(*args, **kwargs)
+        finally:
+            close_generators()
+
+    modellib.data_generator = data_generator
+    keras_model.fit_generator = single_threaded_fit_generator
+    try:
+        yield
+    finally:
+        modellib.data_generator = original_generator
+        del keras_model.fit_generator
+        close_generators()
 
 
 ############################################################
@@ -386,11 +2985,11 @@ if __name__ == '__main__':
         description='Train Mask R-CNN to detect birds.')
     parser.add_argument("command",
                         metavar="<command>",
-                        help="'train' or 'splash'")
+                        help="'train', 'splash', 'evaluate', 'serve' or 'pack'")
     parser.add_argument('--dataset', required=False,
                         metavar="/path/to/birds/dataset/",
                         help='Directory of the birds dataset')
-    parser.add_argument('--weights', required=True,
+    parser.add_argument('--weights', required=False,
                         metavar="/path/to/mask_rcnn_coco.h5",
                         help="Path to weights .h5 file or 'coco'")
     parser.add_argument('--logs', required=False,
@@ -403,37 +3002,165 @@ if __name__ == '__main__':
     parser.add_argument('--video', required=False,
                         metavar="path or URL to video",
                         help='Video to apply the color splash effect on')
+    parser.add_argument('--images', required=False,
+                        metavar="directory, glob or list.txt",
+                        help='Images to apply the color splash effect on in bulk')
+    parser.add_argument('--output', required=False,
+                        metavar="/path/to/output/",
+                        help='Output directory for --images (default=splash/), '
+                             'or for pack (default=<dataset>/shards/)')
+    parser.add_argument('--shards', required=False,
+                        metavar="/path/to/shards/",
+                        help='Train or evaluate on shards written by pack '
+                             'instead of --dataset')
+    parser.add_argument('--shard-mb', required=False,
+                        default=1024, type=int,
+                        metavar="<megabytes>",
+                        help='Size of each shard written by pack (default=1024)')
+    parser.add_argument('--decoded', action="store_true",
+                        help='Make pack store raw RGB pixels instead of the '
+                             'image files, for reads without decoding')
+    parser.add_argument('--detections', required=False,
+                        metavar="/path/to/detections.jsonl",
+                        help='Also write the detections of splash as JSON lines, '
+                             'one per image or video frame, with RLE masks. '
+                             'Compressed if the name ends in .gz')
+    parser.add_argument('--no-splash', action="store_true",
+                        help='Only write --detections, no splash images or video')
+    parser.add_argument('--manifest', required=False,
+                        metavar="/path/to/manifest.txt",
+                        help='Progress file to resume --images runs '
+                             '(default=<output>/splash_manifest.txt)')
+    parser.add_argument('--workers', required=False,
+                        default=0, type=int,
+                        metavar="<count>",
+                        help='Worker processes for loading annotations, for '
+                             '--images and for --prefetch (default=0, run in '
+                             'this process, or one per CPU with --prefetch)')
+    parser.add_argument('--prefetch', required=False,
+                        default=0, type=int,
+                        metavar="<batches>",
+                        help='Train with inputs loaded and augmented by --workers '
+                             'processes, this many batches ahead (default=0, off)')
+    parser.add_argument('--seed', required=False,
+                        default=None, type=int,
+                        help='Random seed of the --prefetch inputs, makes the '
+                             'batches reproducible')
+    parser.add_argument('--batch-size', required=False,
+                        default=1, type=int,
+                        metavar="<count>",
+                        help='Images per detection call, for video frames, '
+                             '--images, --tile, evaluate, and the requests serve '
+                             'batches together (default=1, no batching)')
+    parser.add_argument('--limit', required=False,
+                        default=0, type=int,
+                        metavar="<image count>",
+                        help='Images to use for evaluation (default=0, all)')
+    parser.add_argument('--keyframe-threshold', required=False,
+                        default=None, type=float,
+                        metavar="<score>",
+                        help='Only detect video frames whose mean pixel difference '
+                             'to the last detected frame exceeds this (0-255)')
+    parser.add_argument('--keyframe-interval', required=False,
+                        default=30, type=int,
+                        metavar="<frames>",
+                        help='Detect at least every this many frames with '
+                             '--keyframe-threshold (default=30)')
+    parser.add_argument('--tile', required=False,
+                        default=None, type=int,
+                        metavar="<pixels>",
+                        help='Detect --image or --images in overlapping tiles of '
+                             'this size, e.g. the IMAGE_MAX_DIM of the model')
+    parser.add_argument('--tile-overlap', required=False,
+                        default=128, type=int,
+                        metavar="<pixels>",
+                        help='Overlap of neighboring tiles (default=128)')
+    parser.add_argument('--host', required=False,
+                        default="127.0.0.1",
+                        help='Address for serve to listen on (default=127.0.0.1)')
+    parser.add_argument('--port', required=False,
+                        default=8000, type=int,
+                        help='Port for serve to listen on (default=8000)')
+    parser.add_argument('--socket', required=False,
+                        metavar="/path/to/socket",
+                        help='Unix socket for serve to listen on instead of a port')
+    parser.add_argument('--max-wait-ms', required=False,
+                        default=10, type=float,
+                        metavar="<milliseconds>",
+                        help='How long serve waits to fill a batch (default=10)')
+    parser.add_argument('--metrics', required=False,
+                        metavar="/path/to/metrics.jsonl",
+                        help='Record per-stage timings, fps and peak RSS to a '
+                             'JSONL file, or a Prometheus textfile if it ends in .prom')
+    parser.add_argument('--metrics-interval', required=False,
+                        default=10, type=float,
+                        metavar="<seconds>",
+                        help='Seconds between metrics flushes (default=10)')
+    parser.add_argument('--mask-cache', required=False,
+                        metavar="/path/to/mask/cache/",
+                        help='Directory of a persistent cache of training masks')
+    parser.add_argument('--mask-cache-gb', required=False,
+                        default=4, type=float,
+                        metavar="<size>",
+                        help='Size limit of the mask cache in GB (default=4)')
     args = parser.parse_args()
 
     # Validate arguments
     if args.command == "train":
-        assert args.dataset, "Argument --dataset is required for training"
+        assert args.dataset or args.shards, \
+               "Argument --dataset or --shards is required for training"
+    elif args.command == "evaluate":
+        assert args.dataset or args.shards, \
+               "Argument --dataset or --shards is required for evaluation"
+    elif args.command == "pack":
+        assert args.dataset, "Argument --dataset is required for packing"
     elif args.command == "splash":
-        assert args.image or args.video,\
-               "Provide --image or --video to apply color splash"
+        assert args.image or args.video or args.images,\
+               "Provide --image, --video or --images to apply color splash"
+        assert args.detections or not args.no_splash,\
+               "Provide --detections when using --no-splash"
+        assert not (args.tile and args.video),\
+               "--tile isn't supported with --video"
+        assert not (args.images and args.workers > 1
+                    and args.weights and args.weights.lower() == "imagenet"),\
+               "ImageNet weights can't be used with --images and --workers"
+
+    if args.metrics:
+        enable_metrics(args.metrics, args.metrics_interval)
 
     print("Weights: ", args.weights)
     print("Dataset: ", args.dataset)
     print("Logs: ", args.logs)
 
+    # Deferred imports, see the top of the file
+    from mrcnn import model as modellib, utils
+    BirdsDataset = birds_dataset_class()
+
+    if args.command == "pack":
+        # Packing only needs the datasets, not a model
+        for subset in ["train", "val"]:
+            dataset = BirdsDataset()
+            dataset.load_birds(args.dataset, subset, workers=args.workers)
+            dataset.prepare()
+            pack_birds(dataset, args.output or os.path.join(args.dataset, "shards"),
+                       subset, args.shard_mb * 1024 ** 2, decoded=args.decoded)
+        sys.exit(0)
+    assert args.weights, "Argument --weights is required for {}".format(args.command)
+
     # Configurations
     if args.command == "train":
         config = BirdsConfig()
     else:
-        class InferenceConfig(BirdsConfig):
-            # Set batch size to 1 since we'll be running inference on
-            # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
-            GPU_COUNT = 1
-            IMAGES_PER_GPU = 1
-            DETECTION_MIN_CONFIDENCE = 0
-        config = InferenceConfig()
+        config = InferenceConfig(args.batch_size)
     config.display()
 
-    # Create model
+    # Create model. Bulk splash workers build their own, so the parent
+    # only needs the config and the weights path.
+    model = None
     if args.command == "train":
         model = modellib.MaskRCNN(mode="training", config=config,
                                   model_dir=args.logs)
-    else:
+    elif not (args.command == "splash" and args.images and args.workers > 1):
         model = modellib.MaskRCNN(mode="inference", config=config,
                                   model_dir=args.logs)
 
@@ -445,7 +3172,10 @@ if __name__ == '__main__':
             utils.download_trained_weights(weights_path)
     elif args.weights.lower() == "last":
         # Find last trained weights
-        weights_path = model.find_last()
+        if model is None:
+            weights_path = find_last_weights(config, args.logs)
+        else:
+            weights_path = model.find_last()
     elif args.weights.lower() == "imagenet":
         # Start from ImageNet trained weights
         weights_path = model.get_imagenet_weights()
@@ -454,7 +3184,10 @@ if __name__ == '__main__':
 
     # Load weights
     print("Loading weights ", weights_path)
-    if args.weights.lower() == "coco":
+    if model is None:
+        # Bulk splash workers load the weights themselves
+        pass
+    elif args.weights.lower() == "coco":
         # Exclude the last layers because they require a matching
         # number of classes
         model.load_weights(weights_path, by_name=True, exclude=[
@@ -468,58 +3201,99 @@ if __name__ == '__main__':
         # Training dataset. Use the training set and 35K from the
         # validation set, as as in the Mask RCNN paper.
         dataset_train = BirdsDataset()
-        dataset_train.load_birds(args.dataset, "train")
+        if args.shards:
+            dataset_train.load_shards(args.shards, "train")
+        else:
+            dataset_train.load_birds(args.dataset, "train", workers=args.workers)
         dataset_train.prepare()
+        if args.mask_cache:
+            dataset_train.enable_mask_cache(args.mask_cache,
+                                            int(args.mask_cache_gb * 1024 ** 3))
 
         # Validation dataset
         dataset_val = BirdsDataset()
         val_type = "val" 
-        dataset_val.load_birds(args.dataset, val_type)
+        if args.shards:
+            dataset_val.load_shards(args.shards, val_type)
+        else:
+            dataset_val.load_birds(args.dataset, val_type, workers=args.workers)
         dataset_val.prepare()
 
         # Image Augmentation
         # Right/Left flip 50% of the time
+        from imgaug import augmenters as iaa
 
         augmentation = iaa.SomeOf(2, [
             iaa.Fliplr(0.5),
             iaa.Flipud(0.5),
             iaa.Dropout(p=(0, 0.2))
         ])
+        if METRICS.enabled:
+            augmentation = TimedAugmenter(augmentation)
         # *** This training schedule is an example. Update to your needs ***
+        # Load and augment in worker processes, a few batches ahead
+        training_inputs = contextlib.nullcontext()
+        if args.prefetch:
+            training_inputs = parallel_training_inputs(
+                model, workers=args.workers or os.cpu_count(),
+                prefetch=args.prefetch, seed=args.seed)
+        with training_inputs:
+            # Training - Stage 1
+            print("Training network heads")
+            model.train(dataset_train, dataset_val,
+                        learning_rate=config.LEARNING_RATE,
+                        epochs=40,
+                        layers='heads',
+                        augmentation=augmentation)
 
-        # Training - Stage 1
-        print("Training network heads")
-        model.train(dataset_train, dataset_val,
-                    learning_rate=config.LEARNING_RATE,
-                    epochs=40,
-                    layers='heads',
-                    augmentation=augmentation)
-
-        # Training - Stage 2
-        # Finetune layers from ResNet stage 4 and up
-        print("Fine tune Resnet stage 4 and up")
-        model.train(dataset_train, dataset_val,
-                    learning_rate=config.LEARNING_RATE,
-                    epochs=70,
-                    layers='4+',
-                    augmentation=augmentation)
-        # Training - Stage 3
-        # Fine tune all layers
-        print("Fine tune all layers")
-        model.train(dataset_train, dataset_val,
-                    learning_rate=config.LEARNING_RATE / 10,
-                    epochs=250,
-                    layers='all',
-                    augmentation=augmentation)
-        
+            # Training - Stage 2
+            # Finetune layers from ResNet stage 4 and up
+            print("Fine tune Resnet stage 4 and up")
+            model.train(dataset_train, dataset_val,
+                        learning_rate=config.LEARNING_RATE,
+                        epochs=70,
+                        layers='4+',
+                        augmentation=augmentation)
+            # Training - Stage 3
+            # Fine tune all layers
+            print("Fine tune all layers")
+            model.train(dataset_train, dataset_val,
+                        learning_rate=config.LEARNING_RATE / 10,
+                        epochs=250,
+                        layers='all',
+                        augmentation=augmentation)
+
+    elif args.command == "serve":
+        serve(model, host=args.host, port=args.port, socket_path=args.socket,
+              max_wait=args.max_wait_ms / 1000.0)
+    elif args.command == "splash" and args.images:
+        output_dir = args.output or "splash"
+        splash_images(model, list_images(args.images, exclude_dir=output_dir), output_dir,
+                      manifest_path=args.manifest, workers=args.workers,
+                      weights_path=weights_path, logs_dir=args.logs,
+                      tile_size=args.tile, tile_overlap=args.tile_overlap,
+                      splash=not args.no_splash, detections_path=args.detections,
+                      config=config)
+    elif args.command == "splash":
+        detect_and_color_splash(model, image_path=args.image,
+                                video_path=args.video,
+                                keyframe_threshold=args.keyframe_threshold,
+                                keyframe_interval=args.keyframe_interval,
+                                tile_size=args.tile, tile_overlap=args.tile_overlap,
+                                splash=not args.no_splash,
+                                detections_path=args.detections)
     elif args.command == "evaluate":
         # Validation dataset
         dataset_val = BirdsDataset()
         val_type = "val" 
-        birds = dataset_val.load_birds(args.dataset, val_type,  return_birds=True)
+        if args.shards:
+            dataset_val.load_shards(args.shards, val_type)
+        else:
+            dataset_val.load_birds(args.dataset, val_type, workers=args.workers)
         dataset_val.prepare()
-        print("Running birds evaluation on {} images.".format(args.limit))
-        evaluate_birds(model, dataset_val, birds, "bbox", limit=int(args.limit))
+        print("Running birds evaluation on {} images.".format(
+            args.limit or len(dataset_val.image_ids)))
+        evaluate_birds(model, dataset_val, limit=args.limit, workers=args.workers)
     else:
         print("'{}' is not recognized. "
-              "Use 'train' or 'evaluate'".format(args.command))
\ No newline at end of file
+              "Use 'train', 'splash', 'evaluate', 'serve' or 'pack'".format(args.command))
\ No newline at end of file
@@ -0,0 +1,112 @@
+"""
+Checks that `import birds` stays fast, plus cheap round trips of the
+helpers that don't need a model.
+
+Run from the repository root:
+
+    python3 -m pytest tests/
+
+birds.py imports mrcnn.config, so the Mask R-CNN package must be
+importable.
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+import numpy as np
+import pytest
+
+# Import birds.py from the parent directory
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(REPO_DIR)
+import birds
+
+
+# Modules that `import birds` must not load, since they dominate startup
+HEAVY_MODULES = ["tensorflow", "keras", "mrcnn.model", "mrcnn.utils",
+                 "imgaug", "skimage", "cv2"]
+
+# Median seconds of `import birds` in a fresh interpreter
+IMPORT_BUDGET = 1.0
+
+
+def import_birds():
+    """Import birds in a fresh interpreter.
+    Returns (seconds, heavy modules it loaded).
+    """
+    code = ("import sys, json, time; t = time.perf_counter(); import birds; "
+            "t = time.perf_counter() - t; "
+            "print(json.dumps([t, [m for m in {} if m in sys.modules]]))".format(
+                json.dumps(HEAVY_MODULES)))
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=REPO_DIR)
+    return json.loads(output.decode())
+
+
+def test_import_loads_no_heavy_modules():
+    _, loaded = import_birds()
+    assert loaded == []
+
+
+def test_import_time():
+    times = [import_birds()[0] for _ in range(3)]
+    assert np.median(times) <= IMPORT_BUDGET
+
+
+@pytest.mark.parametrize("mask", [
+    np.zeros([0, 5], dtype=bool),
+    np.zeros([4, 5], dtype=bool),
+    np.ones([4, 5], dtype=bool),
+    np.eye(6, dtype=bool),
+    np.random.RandomState(0).rand(31, 17) > 0.5,
+])
+def test_rle_round_trip(mask):
+    counts = birds.encode_rle(mask)
+    assert sum(counts) == mask.size
+    assert np.array_equal(birds.decode_rle(counts, mask.shape), mask)
+
+
+def test_rle_column_major():
+    # COCO order: down the first column, then the next
+    mask = np.array([[1, 0],
+                     [1, 1]], dtype=bool)
+    assert birds.encode_rle(mask) == [0, 2, 1, 1]
+
+
+def test_iter_via_annotations(tmp_path):
+    annotations = {
+        "a.jpg123": {"filename": "a.jpg", "size": 123, "file_attributes": {},
+                     "regions": [{"shape_attributes": {
+                                     "name": "polygon",
+                                     "all_points_x": [1, 5, 9],
+                                     "all_points_y": [2, 8, 3]},
+                                  "region_attributes": {"birds": "1"}}]},
+        "b \"quoted\" {}.jpg7": {"filename": "b \"quoted\" {}.jpg", "size": 7,
+                                 "file_attributes": {}, "regions": {}},
+    }
+    path = str(tmp_path / "via_region_data.json")
+    with open(path, "w") as f:
+        json.dump(annotations, f, indent=2)
+    expected = list(annotations.values())
+    # Chunks small enough to cut every token, and one that reads it all
+    for chunk_size in [1, 3, 64, 1024 ** 2]:
+        assert list(birds.iter_via_annotations(path, chunk_size)) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("{}", []),
+    (" {\n} ", []),
+    ('{"a": 1, "b": [2]}', [1, [2]]),
+])
+def test_iter_via_annotations_small(tmp_path, text, expected):
+    path = tmp_path / "via_region_data.json"
+    path.write_text(text)
+    assert list(birds.iter_via_annotations(str(path), chunk_size=2)) == expected
+
+
+def test_iter_via_annotations_malformed(tmp_path):
+    path = tmp_path / "via_region_data.json"
+    path.write_text('{"a": 1 "b": 2}')
+    with pytest.raises(ValueError):
+        list(birds.iter_via_annotations(str(path)))